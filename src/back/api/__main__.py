@@ -1,12 +1,81 @@
-import os, uvicorn
+import logging, os, signal, uvicorn
 
 HOST = os.getenv('API_HOST', '0.0.0.0')
 PORT = int(os.getenv('API_PORT', '8000'))
 WORKERS = int(os.getenv('API_WORKERS', '-1'))
+PRELOAD = os.getenv('API_PRELOAD', '0') == '1'
+STARTUP_FAILURE = 3
+
+logger = logging.getLogger("uvicorn.error")
+
+
+
+
+def serve_preloaded(workers: int):
+    """
+    Load the models once, then fork the workers on a shared socket.
+    Forked workers share the pages of the weights until they write to them,
+    instead of loading a copy each. Workers dying after their
+    startup are replaced.
+    :param workers: number of worker processes
+    """
+    from .api import app, preload
+    config = uvicorn.Config(app, host = HOST, port = PORT, reload = False)
+    sock = config.bind_socket()
+    preload()
+
+    pids = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = STARTUP_FAILURE
+            try:
+                server = uvicorn.Server(config)
+                server.run(sockets = [sock])
+                if server.started: code = 0
+            finally:
+                os._exit(code)
+        pids.add(pid)
+        logger.info("Started worker process [%d]", pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try: os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError: pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(workers): spawn()
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        pids.discard(pid)
+        code = os.waitstatus_to_exitcode(status)
+        if code == STARTUP_FAILURE:
+            logger.error("Worker process [%d] failed to start", pid)
+        elif not stopping:
+            logger.warning("Worker process [%d] exited with %d, restarting", pid, code)
+            spawn()
+    sock.close()
+
+
+
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "api:app",
-        host = HOST, port = PORT,
-        reload = False, workers = WORKERS,
-    )
\ No newline at end of file
+    if PRELOAD:
+        serve_preloaded(max(WORKERS, 1))
+    else:
+        uvicorn.run(
+            "api:app",
+            host = HOST, port = PORT,
+            reload = False, workers = WORKERS,
+        )
@@ -1,31 +1,175 @@
+import asyncio, gc, os
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from functools import partial
 from fastapi import (
     FastAPI, WebSocket,
-    WebSocketException
+    WebSocketException,
+    WebSocketDisconnect,
+    HTTPException,
+    Response,
+    Query
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from models.cache import LRUCache, RedisCache, TieredCache
+from models.registry import ModelRegistry
+from models.stores import DocumentStorePool
+from models.workers import InferencePool, Overloaded
+from models.wordnet import load as load_wordnet
 from models.utils import (
     token_pipeline,
+    warm_up_pipeline,
+    redis_connection,
     EQA
 )
-from nltk.corpus import wordnet as wn
+from pydantic import BaseModel
+from typing import Optional
+from .augmentation import QueryAugmenter, CACHE_SIZE, CACHE_TTL
 from .consummer import Discussion
-from .search import search_articles, get_article_by_id
+from .process import memory, children
+from .search import (
+    search_articles,
+    async_search_articles,
+    search_batch,
+    search_page,
+    export_articles,
+    async_export_articles,
+    async_search_page,
+    CursorExpired,
+    PAGE_SIZE,
+    get_article_by_id,
+    get_articles_by_ids,
+    es_connection
+)
 
-wn.ensure_loaded()
 import warnings
 warnings.filterwarnings('ignore')
 
+ASYNC_SEARCH = os.getenv('API_ASYNC_SEARCH', '1') == '1'
+SPACY_WORKERS = int(os.getenv('API_SPACY_WORKERS', '2'))
+AUG_CACHE_REDIS = os.getenv('AUG_CACHE_REDIS', '1') == '1'
+BATCH_MAX = int(os.getenv('API_BATCH_MAX', '500'))
+BATCH_SIZE = int(os.getenv('API_BATCH_SIZE', '32'))
+PAGE_MAX = int(os.getenv('SEARCH_PAGE_MAX', '100'))
+PAGE_TTL = float(os.getenv('SEARCH_PAGE_TTL', '600'))
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '500'))
+EXPORT_PAGE_MAX = int(os.getenv('EXPORT_PAGE_MAX', '5000'))
+ARTICLES_MAX = int(os.getenv('API_ARTICLES_MAX', '100'))
+ARTICLE_CACHE_SIZE = int(os.getenv('ARTICLE_CACHE_SIZE', '2048'))
+ARTICLE_CACHE_TTL = float(os.getenv('ARTICLE_CACHE_TTL', '900'))
+
 
 pipes = dict()
-@asynccontextmanager
-async def pipelines(*args, **kwargs):
+preloaded = False
+
+
+
+
+def preload():
     """
-    Load pipelines
+    Load the models into `pipes` before the workers fork,
+    see `python -m api` with API_PRELOAD. The lifespan of each
+    worker then keeps them, their weights are shared copy-on-write.
     """
+    global preloaded
+    load_wordnet()
     pipes['token'] = token_pipeline()
     pipes['EQA'] = EQA()
+    # keep the collector from writing to the inherited objects
+    gc.collect()
+    gc.freeze()
+    preloaded = True
+
+
+
+
+def preloaded_or(name: str, factory):
+    """
+    Model loaded by `preload`, else a new one
+    """
+    return pipes[name] if name in pipes else factory()
+
+
+def token_ready(model):
+    """
+    Publish the token pipeline and the query augmentation
+    """
+    pipes['token'] = model
+    pipes['augmenter'] = QueryAugmenter(
+        model,
+        cache = TieredCache(
+            LRUCache(maxsize = CACHE_SIZE, ttl = CACHE_TTL),
+            RedisCache(pipes['redis'], 'aug', ttl = CACHE_TTL)
+            if AUG_CACHE_REDIS else None,
+        )
+    )
+
+
+def eqa_ready(model: EQA):
+    """
+    Publish the EQA pipeline and the document stores of its sessions
+    """
+    pipes['EQA'] = model
+    pipes['stores'] = DocumentStorePool(
+        model.create_document_store,
+        model.embed_documents,
+    )
+
+
+def require(*names: str):
+    """
+    Answer 503 until models are ready
+    """
+    if not pipes['models'].ready(*names):
+        raise HTTPException(
+            status_code = 503,
+            detail = "Models loading, retry later",
+            headers = {"Retry-After": "5"},
+        )
+
+
+
+
+@asynccontextmanager
+async def pipelines(*args, **kwargs):
+    """
+    Load pipelines. Models load in the background, the endpoints
+    answer 503 until the models they use are ready.
+    """
+    pipes['es'] = es_connection()
+    if ASYNC_SEARCH:
+        pipes['aes'] = es_connection(use_async=True)
+        pipes['executor'] = ThreadPoolExecutor(
+            max_workers = SPACY_WORKERS,
+            thread_name_prefix = 'spacy'
+        )
+    pipes['articles'] = LRUCache(maxsize = ARTICLE_CACHE_SIZE, ttl = ARTICLE_CACHE_TTL)
+    pipes['redis'] = redis_connection()
+    pipes['pages'] = TieredCache(
+        LRUCache(maxsize = CACHE_SIZE, ttl = PAGE_TTL),
+        RedisCache(pipes['redis'], 'page', ttl = PAGE_TTL),
+    )
+    pipes['inference'] = InferencePool()
+    pipes['models'] = ModelRegistry()
+    pipes['models'].load('wordnet', load_wordnet)
+    pipes['models'].load(
+        'token', partial(preloaded_or, 'token', token_pipeline),
+        warm_up = warm_up_pipeline, on_ready = token_ready,
+    )
+    pipes['models'].load(
+        'EQA', partial(preloaded_or, 'EQA', EQA),
+        warm_up = EQA.warm_up, on_ready = eqa_ready,
+    )
     yield
+    pipes['models'].close()
+    pipes['inference'].close()
+    if 'augmenter' in pipes: pipes['augmenter'].close()
+    pipes['es'].close()
+    if ASYNC_SEARCH:
+        await pipes['aes'].close()
+        pipes['executor'].shutdown(wait=False, cancel_futures=True)
     pipes.clear()
 
 
@@ -63,15 +207,127 @@ async def root():
 
 
 
+@app.get(
+    "/api/ready",
+    summary = "Load state, load and warm-up seconds of the models",
+)
+def ready(response: Response, model: Optional[str] = None):
+    """
+    Answers 503 until the models, or the given one, are ready
+    """
+    models = pipes['models']
+    if model is not None and model not in models.states:
+        raise HTTPException(status_code = 404, detail = f"Unknown model {model}")
+    if not models.ready(*([model] if model else [])):
+        response.status_code = 503
+    return models.stats()
+
+
+
+
 @app.get(
     "/api/search",
     summary = "Search articles to answer questions",
 )
-def search(query: str):
-    response = search_articles(query, pipes['token'])
+async def search(
+    query: Optional[str] = None,
+    size: int = Query(PAGE_SIZE, ge = 1, le = PAGE_MAX),
+    paginate: bool = False,
+    cursor: Optional[str] = None,
+):
+    """
+    With `paginate` or a `cursor`, results carry the cursor of the next page
+    """
+    if query is None and cursor is None:
+        raise HTTPException(status_code = 422, detail = "query or cursor is required")
+    require('token', 'wordnet')
+    if paginate or cursor is not None:
+        return await search_pages(query, size, cursor)
+    if ASYNC_SEARCH:
+        return await async_search_articles(
+            query, pipes['augmenter'], pipes['aes'], pipes['executor'],
+            size = size
+        )
+    response = await run_in_threadpool(
+        search_articles, query, pipes['augmenter'], pipes['es'],
+        size = size
+    )
     return response
 
 
+async def search_pages(
+    query: Optional[str],
+    size: int,
+    cursor: Optional[str],
+):
+    try:
+        if ASYNC_SEARCH:
+            return await async_search_page(
+                query, pipes['augmenter'], pipes['aes'], pipes['executor'],
+                pipes['pages'], size = size, cursor = cursor
+            )
+        return await run_in_threadpool(
+            search_page, query, pipes['augmenter'], pipes['es'],
+            pipes['pages'], size = size, cursor = cursor
+        )
+    except CursorExpired as e:
+        raise HTTPException(status_code = 410, detail = str(e))
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+
+
+
+
+@app.get(
+    "/api/search/export",
+    summary = "Stream every article answering a question, as NDJSON",
+)
+async def export(
+    query: str,
+    page_size: int = Query(EXPORT_PAGE_SIZE, ge = 1, le = EXPORT_PAGE_MAX),
+):
+    """
+    Errors of the first page are raised before streaming, a later
+    failure ends the stream with an `error` record
+    """
+    require('token', 'wordnet')
+    if ASYNC_SEARCH:
+        rows = await async_export_articles(
+            query, pipes['augmenter'], pipes['aes'], pipes['executor'],
+            page_size = page_size
+        )
+    else:
+        rows = await run_in_threadpool(
+            export_articles, query, pipes['augmenter'], pipes['es'],
+            page_size = page_size
+        )
+    return StreamingResponse(rows, media_type = "application/x-ndjson")
+
+
+
+
+class BatchQuery(BaseModel):
+    queries: list[str]
+
+
+@app.post(
+    "/api/search/batch",
+    summary = "Search articles to answer many questions",
+)
+def search_many(batch: BatchQuery):
+    if len(batch.queries) > BATCH_MAX:
+        raise HTTPException(
+            status_code = 413,
+            detail = f"At most {BATCH_MAX} queries per batch"
+        )
+    require('token', 'wordnet')
+    results = search_batch(
+        batch.queries, pipes['augmenter'], pipes['es'],
+        batch_size = BATCH_SIZE
+    )
+    return {"results": results}
+
+
 
 
 @app.get(
@@ -79,12 +335,125 @@ def search(query: str):
     summary = "Get article",
 )
 def get_article(id: str):
-    article = get_article_by_id(id)
+    article = get_article_by_id(id, pipes['es'], pipes['articles'])
     return article
 
 
 
 
+class ArticlesQuery(BaseModel):
+    ids: list[str]
+
+
+@app.post(
+    "/api/articles",
+    summary = "Get articles",
+)
+def get_articles(selection: ArticlesQuery):
+    if len(selection.ids) > ARTICLES_MAX:
+        raise HTTPException(
+            status_code = 413,
+            detail = f"At most {ARTICLES_MAX} articles per request"
+        )
+    articles = get_articles_by_ids(selection.ids, pipes['es'], pipes['articles'])
+    return {"articles": articles}
+
+
+
+
+@app.get(
+    "/api/stats/es",
+    summary = "Elasticsearch connection pool statistics",
+)
+def es_stats():
+    stats = {"nodes": pipes['es'].stats()}
+    if ASYNC_SEARCH:
+        stats["async_nodes"] = pipes['aes'].stats()
+    return stats
+
+
+
+
+@app.get(
+    "/api/stats/augmentation",
+    summary = "Query augmentation counters",
+)
+def augmentation_stats():
+    require('token')
+    return pipes['augmenter'].stats()
+
+
+
+
+@app.get(
+    "/api/stats/eqa",
+    summary = "Question answering counters",
+)
+def eqa_stats():
+    require('EQA')
+    return pipes['EQA'].stats()
+
+
+
+
+@app.get(
+    "/api/admin/embeddings",
+    summary = "Embedding cache size, hit ratio and keys per model",
+)
+def embeddings_report():
+    require('EQA')
+    return pipes['EQA'].embeddings.report()
+
+
+
+
+@app.get(
+    "/api/stats/inference",
+    summary = "Question answering queue depth, rejections and timeouts",
+)
+def inference_stats():
+    return pipes['inference'].stats()
+
+
+
+
+@app.get(
+    "/api/stats/stores",
+    summary = "Shared document stores of the websocket sessions",
+)
+def stores_stats():
+    require('EQA')
+    return pipes['stores'].stats()
+
+
+
+
+@app.get(
+    "/api/stats/process",
+    summary = "Memory of the API processes, in MB",
+)
+def process_stats():
+    pid = os.getpid()
+    stats = {"pid": pid, "preloaded": preloaded, "memory": memory(pid)}
+    if preloaded:
+        master = os.getppid()
+        stats["master"] = memory(master)
+        stats["workers"] = {worker: memory(worker) for worker in children(master)}
+    return stats
+
+
+
+
+@app.get(
+    "/api/stats/articles",
+    summary = "Article cache statistics",
+)
+def articles_stats():
+    return pipes['articles'].stats()
+
+
+
+
 @app.websocket(
     "/ws/{client_id}",
 )
@@ -98,16 +467,29 @@ async def discuss(
     try:
         while True:
             data = await websocket.receive_json()
-            if data['type'] == 'select_articles':
-                await discussion.select_articles(pipes['EQA'].create_document_store, data['articles'])
-                await websocket.send_json({"message": "Articles selected"})
-            elif data['type'] == 'discuss':
-                results = await discussion.discuss(pipes['EQA'], data['query'])
-                await websocket.send_json(dict(
-                    type = 'question.answered',
-                    data = results
-                ))
-            else:
-                await websocket.send_json({"error": "Invalid type"})
-    except WebSocketException:
-        pass
\ No newline at end of file
+            try:
+                if data['type'] in ('select_articles', 'discuss') and not pipes['models'].ready('EQA'):
+                    await websocket.send_json({"error": "Models loading, retry later", "status": 503})
+                elif data['type'] == 'select_articles':
+                    await discussion.select_articles(
+                        pipes['inference'], pipes['stores'], data['articles']
+                    )
+                    await websocket.send_json({"message": "Articles selected"})
+                elif data['type'] == 'discuss':
+                    results = await discussion.discuss(
+                        pipes['inference'], pipes['EQA'], data['query']
+                    )
+                    await websocket.send_json(dict(
+                        type = 'question.answered',
+                        data = results
+                    ))
+                else:
+                    await websocket.send_json({"error": "Invalid type"})
+            except Overloaded:
+                await websocket.send_json({"error": "Server busy, retry later", "status": 503})
+            except asyncio.TimeoutError:
+                await websocket.send_json({"error": "Question timed out", "status": 504})
+    except (WebSocketException, WebSocketDisconnect):
+        pass
+    finally:
+        if 'stores' in pipes: discussion.close(pipes['stores'])
\ No newline at end of file
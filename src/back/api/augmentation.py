@@ -0,0 +1,353 @@
+import logging, os, re, time, unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import partial
+from threading import Lock
+from typing import Any, Optional
+from .search import as_question, augment_doc
+
+logger = logging.getLogger(__name__)
+
+DEADLINE = float(os.getenv('AUG_DEADLINE', '5'))
+RETRIES = int(os.getenv('AUG_RETRIES', '2'))
+BACKOFF = float(os.getenv('AUG_BACKOFF', '0.1'))
+LINKER_TIMEOUT = float(os.getenv('EF_TIMEOUT', '2'))
+BREAKER_FAILURES = int(os.getenv('EF_BREAKER_FAILURES', '5'))
+BREAKER_RESET = float(os.getenv('EF_BREAKER_RESET', '30'))
+CACHE_SIZE = int(os.getenv('AUG_CACHE_SIZE', '1024'))
+CACHE_TTL = float(os.getenv('AUG_CACHE_TTL', '3600'))
+
+
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing remote service for a while.
+    Closed: calls go through. Open: calls are refused until `reset_timeout`
+    has elapsed. Half-open: a single probe call decides to close or reopen.
+    """
+    def __init__(
+        self,
+        failures: int = BREAKER_FAILURES,
+        reset_timeout: float = BREAKER_RESET,
+    ):
+        """
+        :param failures: consecutive failures before opening
+        :param reset_timeout: seconds before a probe call is allowed
+        """
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = Lock()
+
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None: return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout: return 'half-open'
+        return 'open'
+
+
+    def allow(self) -> bool:
+        """
+        Whether a call can be made now
+        """
+        with self._lock:
+            state = self.state
+            if state == 'closed': return True
+            if state == 'half-open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+
+
+class QueryAugmenter:
+    """
+    Bounded query augmentation.
+    Runs the spaCy pipeline with the entity-fishing call guarded by a
+    timeout and a circuit breaker, retries failed attempts with exponential
+    backoff until a deadline, then falls back to the raw keywords.
+    """
+    def __init__(
+        self,
+        pipeline,
+        deadline: float = DEADLINE,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        linker_timeout: float = LINKER_TIMEOUT,
+        breaker: Optional[CircuitBreaker] = None,
+        linker: str = 'entityfishing',
+        cache = None,
+    ):
+        """
+        :param pipeline: spaCy pipeline, see `models.utils.token_pipeline`
+        :param deadline: seconds allowed for the whole augmentation
+        :param retries: retries after a failed attempt
+        :param backoff: first backoff in seconds, doubled on each retry
+        :param linker_timeout: seconds allowed for the entity-fishing call
+        :param breaker: circuit breaker around the entity-fishing call
+        :param linker: name of the entity-fishing component
+        :param cache: cache of augmentations keyed on `normalize_question`,
+            see `models.cache`. Degraded results are not cached.
+        """
+        self.pipeline = pipeline
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.linker_timeout = linker_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.linker = linker if linker in pipeline.pipe_names else None
+        self.cache = cache
+        self.counters = Counter()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers = int(os.getenv('EF_WORKERS', '4')),
+            thread_name_prefix = 'entityfishing'
+        )
+
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Counters of the augmentation stage
+        """
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            **counters,
+            "breaker": self.breaker.state,
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "linker": getattr(self.pipeline.get_pipe(self.linker), 'stats', dict)()
+            if self.linker is not None else None,
+        }
+
+
+    def _link(self, doc, deadline: float):
+        """
+        Private. Run entity-fishing on a copy of the doc.
+        The copy is dropped on timeout, the remote call may still be running.
+        """
+        if self.linker is None: return doc
+        if not self.breaker.allow():
+            self.count('linker_skipped')
+            doc.user_data['unlinked'] = True
+            return doc
+        return self._guard(
+            partial(self.pipeline.get_pipe(self.linker), doc.copy()),
+            min(self.linker_timeout, deadline - time.monotonic())
+        )
+
+
+    def _link_many(self, docs: list, deadline: float, batch_size: int) -> list:
+        """
+        Private. Run entity-fishing on copies of docs with the component
+        `pipe`, a request per spaCy batch. The breaker and the timeout,
+        of `linker_timeout` per batch, guard the whole call; on failure
+        every doc is kept unlinked.
+        """
+        if self.linker is None or not docs: return docs
+        if not self.breaker.allow():
+            self.count('linker_skipped', len(docs))
+            for doc in docs: doc.user_data['unlinked'] = True
+            return docs
+        proc = self.pipeline.get_pipe(self.linker)
+        copies = [doc.copy() for doc in docs]
+        if hasattr(proc, 'pipe'):
+            call = lambda: list(proc.pipe(copies, batch_size = batch_size))
+        else:
+            call = lambda: [proc(doc) for doc in copies]
+        batches = -(-len(docs) // batch_size)
+        try:
+            return self._guard(
+                call,
+                min(self.linker_timeout * batches, deadline - time.monotonic())
+            )
+        except Exception:
+            for doc in docs: doc.user_data['unlinked'] = True
+            return docs
+
+
+    def _guard(self, call, timeout: float):
+        """
+        Private. Run an entity-fishing call in the linker threads,
+        through the circuit breaker, the breaker must allow it
+        :param call: function without arguments
+        :param timeout: seconds to wait for the call
+        """
+        future = self._executor.submit(call)
+        try:
+            linked = future.result(timeout = max(0., timeout))
+        except TimeoutError:
+            self.count('linker_timeouts')
+            self.breaker.failure()
+            raise
+        except Exception:
+            self.count('linker_errors')
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return linked
+
+
+    def parse(self, keywords: str, deadline: float):
+        """
+        Run the pipeline, the entity-fishing component is guarded.
+        :param keywords: str. question
+        :param deadline: time.monotonic() deadline
+        """
+        doc = self.pipeline.make_doc(as_question(keywords))
+        for name, proc in self.pipeline.pipeline:
+            doc = self._link(doc, deadline) if name == self.linker else proc(doc)
+        return doc
+
+
+    def __call__(self, keywords: str):
+        """
+        Augment query, see `api.search.augment_doc` for the output.
+        :param keywords: str. question
+        """
+        self.count('requests')
+        key = normalize_question(keywords)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None: return cached
+
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.retries + 1):
+            try:
+                doc = self.parse(keywords, deadline)
+                augmented = augment_doc(doc)
+                self._store(key, doc, augmented)
+                return augmented
+            except Exception as e:
+                self.count('errors')
+                logger.warning("Query augmentation failed (attempt %d): %r", attempt + 1, e)
+            delay = self.backoff * 2 ** attempt
+            if attempt == self.retries: break
+            if time.monotonic() + delay >= deadline:
+                self.count('timeouts')
+                break
+            time.sleep(delay)
+        self.count('fallbacks')
+        return fallback_query(keywords)
+
+
+    def _store(self, key: str, doc, augmented):
+        """
+        Private. Cache an augmentation, unless entity-fishing was skipped
+        """
+        if self.cache is not None and not doc.user_data.get('unlinked'):
+            self.cache.set(key, augmented)
+
+
+    def augment_many(self, questions: list[str], batch_size: int = 32) -> list:
+        """
+        Augment many questions at once.
+        Cache misses go through each spaCy component `pipe` in batches,
+        entity-fishing failures degrade the question instead of retrying,
+        and questions failing augmentation take the single question path.
+        :param questions: list of questions
+        :param batch_size: spaCy batch size
+        :return: augmentations in input order, see `api.search.augment_doc`
+        """
+        self.count('requests', len(questions))
+        keys = [normalize_question(question) for question in questions]
+        results = [
+            self.cache.get(key) if self.cache is not None else None
+            for key in keys
+        ]
+        missing, docs = [], []
+        for i, result in enumerate(results):
+            if result is not None: continue
+            try:
+                docs.append(self.pipeline.make_doc(as_question(questions[i])))
+                missing.append(i)
+            except Exception:
+                self.count('errors')
+                self.count('fallbacks')
+                results[i] = fallback_query(questions[i])
+        if not missing: return results
+
+        try:
+            docs = list(self._pipe(docs, batch_size, time.monotonic() + self.deadline))
+        except Exception as e:
+            # a component failed on the batch: each question is parsed alone
+            logger.warning("Batch augmentation failed: %r", e)
+            self.count('errors')
+            docs = [None] * len(missing)
+
+        for i, doc in zip(missing, docs):
+            try:
+                if doc is None: raise ValueError("not parsed")
+                results[i] = augment_doc(doc)
+                self._store(keys[i], doc, results[i])
+            except Exception:
+                self.count('errors')
+                self.count('requests', -1)
+                results[i] = self(questions[i])
+        return results
+
+
+    def _pipe(self, docs: list, batch_size: int, deadline: float):
+        """
+        Private. Run the pipeline components on docs, in batches
+        """
+        for name, proc in self.pipeline.pipeline:
+            if name == self.linker:
+                docs = self._link_many(list(docs), deadline, batch_size)
+            elif hasattr(proc, 'pipe'):
+                docs = proc.pipe(docs, batch_size = batch_size)
+            else:
+                docs = map(proc, docs)
+        return docs
+
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+
+
+def normalize_question(keywords: str) -> str:
+    """
+    Cache key of a question: case, spacing and trailing punctuation
+    do not change the augmentation much.
+    :param keywords: str. question
+    """
+    keywords = unicodedata.normalize('NFKC', keywords).lower()
+    keywords = re.sub(r'\s+', ' ', keywords)
+    return keywords.strip(' ?!.')
+
+
+
+
+def fallback_query(keywords: str):
+    """
+    Degraded augmentation: the raw keywords, without synonyms nor phrases.
+    :param keywords: str. question
+    """
+    aug_keywords = [dict(keyword=[word], type=None) for word in keywords.split()]
+    return aug_keywords, {}, [], [], keywords
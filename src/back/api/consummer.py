@@ -1,4 +1,7 @@
+import asyncio
 from fastapi import WebSocket
+from models.stores import DocumentStorePool
+from models.workers import InferencePool
 from typing import Callable
 
 
@@ -9,26 +12,58 @@ class Discussion:
         self.client_id = client_id
         self.websocket = websocket
         self.document_store = None
+        self.store_key = None
         self.articles = list()
     
     async def select_articles(
         self,
-        method: Callable,
+        workers: InferencePool,
+        pool: DocumentStorePool,
         articles: list[dict[str, str]],
     ):
         """
-        Create document store
+        Get the document store of the selection from the shared pool.
+        Not timed out: the previous selection is released by the job
         """
+        self.store_key, self.document_store = await workers.run(
+            pool.acquire, articles, self.store_key, timeout = None
+        )
         self.articles = articles
-        self.document_store = method(articles)
+    
+    def close(self, pool: DocumentStorePool):
+        """
+        Release the document store of the selection
+        """
+        pool.release(self.store_key)
+        self.store_key, self.document_store = None, None
     
     async def discuss(
         self,
+        workers: InferencePool,
         method: Callable,
         query: str,
     ):
         """
-        Discuss with selection of articles
+        Discuss with selection of articles.
+        Partial results are sent as they come, before the returned results
         """
-        return method(query, self.document_store, self.articles)
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def on_event(type: str, data):
+            # called from the inference worker
+            loop.call_soon_threadsafe(events.put_nowait, dict(type = type, data = data))
+
+        async def send():
+            while (event := await events.get()) is not None:
+                await self.websocket.send_json(event)
+
+        sender = asyncio.create_task(send())
+        try:
+            return await workers.run(
+                method, query, self.document_store, self.articles, on_event
+            )
+        finally:
+            events.put_nowait(None)
+            await sender
     
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+Pre-embed the abstracts of the Elasticsearch index into the embedding cache,
+so that selecting an article never pays the encoding in the websocket.
+
+    python -m api.preembed --workers 4 --batch-size 256
+
+Abstracts are walked with a point in time, encoded with the EQA dense model
+across a process pool and written to Redis with pipelined writes. Progress
+is checkpointed after each page: rerun the same command to resume. If the
+point in time expired meanwhile, the walk restarts and skips the articles
+already cached.
+"""
+import argparse, json, logging, os, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from elasticsearch import NotFoundError
+from elasticsearch_dsl import Q
+from haystack.schema import Document
+from models.cache import EmbeddingCache
+from models.utils import (
+    dense_retriever,
+    embedding_model,
+    redis_connection,
+    BACKEND,
+    DENSE_MODEL,
+    EMBEDDING_DTYPE,
+    EMBEDDING_TTL,
+    EMBEDDING_VERSION,
+)
+from .search import es_connection, paginate_query
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT = os.getenv('PREEMBED_CHECKPOINT', '.cache/preembed.json')
+
+_retriever = None
+
+
+
+
+def _init_worker(model: str, threads: int, backend: str):
+    """
+    Private. Load the dense retriever once per worker process
+    """
+    global _retriever
+    import torch
+    torch.set_num_threads(threads)
+    _retriever = dense_retriever(model, backend)
+
+
+def _dimension() -> int:
+    """
+    Private. Embedding dimension, probed like `models.utils.EQA`
+    """
+    return len(_retriever.embed_queries(["dimension"])[0])
+
+
+def _encode(documents: list[tuple[str, str]]) -> dict:
+    """
+    Private. Encode (id, abstract) pairs in a worker process
+    """
+    documents = [Document(id = id, content = content) for id, content in documents]
+    embeddings = _retriever.embed_documents(documents)
+    return {doc.id: embedding for doc, embedding in zip(documents, embeddings)}
+
+
+
+
+def scan_abstracts(connection, pit: str, after = None, page_size: int = 1000):
+    """
+    Walk the articles having an abstract
+    :param connection: ESManager
+    :param pit: point in time id
+    :param after: sort values to resume after
+    :param page_size: articles per request
+    :return: generator of ([(id, abstract)], pit, after) pages
+    """
+    kwargs = {
+        'query': Q('exists', field = 'abstract').to_dict(),
+        'sources': ['abstract'],
+        'extras': {'track_total_hits': False},
+    }
+    while True:
+        results = connection.search(**paginate_query(kwargs, pit, after, page_size))
+        raw = results.to_dict()
+        hits, pit = raw['hits']['hits'], raw.get('pit_id', pit)
+        if not hits: return
+        after = hits[-1]['sort']
+        yield [(hit['_id'], hit['_source']['abstract']) for hit in hits], pit, after
+        if len(hits) < page_size: return
+
+
+
+
+class Checkpoint:
+    """
+    Progress of a pre-embedding job, stored as JSON
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.state = dict(pit = None, after = None, encoded = 0, skipped = 0)
+        if os.path.exists(path):
+            with open(path) as f: self.state.update(json.load(f))
+
+
+    def save(self, **state):
+        self.state.update(state)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f: json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+    def clear(self):
+        if os.path.exists(self.path): os.remove(self.path)
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default = DENSE_MODEL)
+    parser.add_argument("--backend", default = BACKEND, choices = ["torch", "onnx"])
+    parser.add_argument("--workers", type = int, default = max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--threads", type = int, default = 2, help = "torch threads per worker")
+    parser.add_argument("--batch-size", type = int, default = 256, help = "abstracts per encoding task")
+    parser.add_argument("--page-size", type = int, default = 2000, help = "abstracts per Elasticsearch request")
+    parser.add_argument("--keep-alive", default = "30m", help = "point in time keep alive")
+    parser.add_argument("--checkpoint", default = CHECKPOINT)
+    parser.add_argument("--restart", action = "store_true", help = "ignore the checkpoint")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(message)s")
+
+    connection = es_connection()
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.restart: checkpoint.clear(); checkpoint = Checkpoint(args.checkpoint)
+    pit, after = checkpoint.state['pit'], checkpoint.state['after']
+    if pit is None: pit = connection.open_pit(args.keep_alive)
+
+    encoded, skipped = checkpoint.state['encoded'], checkpoint.state['skipped']
+
+    def pages(pit, after):
+        try:
+            yield from scan_abstracts(connection, pit, after, args.page_size)
+        except NotFoundError:
+            logger.info("Point in time expired, restarting, cached articles are skipped")
+            yield from scan_abstracts(connection, connection.open_pit(args.keep_alive), None, args.page_size)
+
+    with ProcessPoolExecutor(
+        max_workers = args.workers,
+        initializer = _init_worker,
+        initargs = (args.model, args.threads, args.backend),
+    ) as pool:
+        cache = EmbeddingCache(
+            redis_connection(decode_responses = False),
+            model = embedding_model(args.model, args.backend),
+            dim = pool.submit(_dimension).result(),
+            version = EMBEDDING_VERSION,
+            dtype = EMBEDDING_DTYPE,
+            ttl = EMBEDDING_TTL,
+            legacy = False,
+        )
+        start, done = time.monotonic(), 0
+        # (future, size, pit, after): after is set on the last task of a page,
+        # future is None for a page without article to encode
+        pending = deque()
+
+        def drain(limit: int):
+            nonlocal encoded, done
+            while len(pending) > limit:
+                future, size, page_pit, page_after = pending.popleft()
+                if future is not None: cache.set_many(future.result())
+                encoded, done = encoded + size, done + size
+                if page_after is not None:
+                    checkpoint.save(pit = page_pit, after = page_after, encoded = encoded, skipped = skipped)
+                    logger.info(
+                        "%d encoded, %d skipped, %.1f docs/sec",
+                        encoded, skipped, done / (time.monotonic() - start)
+                    )
+
+        for page, pit, after in pages(pit, after):
+            exists = cache.exists_many([id for id, _ in page])
+            missing = [doc for doc, found in zip(page, exists) if not found]
+            skipped += len(page) - len(missing)
+            tasks = [missing[i:i + args.batch_size] for i in range(0, len(missing), args.batch_size)]
+            for i, task in enumerate(tasks):
+                last = i == len(tasks) - 1
+                pending.append((pool.submit(_encode, task), len(task), pit, after if last else None))
+            if not tasks:
+                pending.append((None, 0, pit, after))
+            # keep the workers busy while bounding the abstracts held in memory
+            drain(2 * args.workers)
+        drain(0)
+
+    connection.close_pit(pit)
+    checkpoint.clear()
+    elapsed = time.monotonic() - start
+    print(
+        f"{encoded} articles encoded, {skipped} already cached, "
+        f"{done} in {elapsed:.0f}s: {done / elapsed if elapsed else 0:.1f} docs/sec"
+    )
+
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import os
+from typing import Optional
+
+# fields of /proc/<pid>/smaps_rollup, in kB
+MEMORY_FIELDS = {
+    'Rss': 'rss',
+    'Pss': 'pss',
+    'Shared_Clean': 'shared_clean',
+    'Shared_Dirty': 'shared_dirty',
+    'Private_Clean': 'private_clean',
+    'Private_Dirty': 'private_dirty',
+}
+
+
+
+
+def memory(pid: int) -> Optional[dict[str, float]]:
+    """
+    Memory of a process in MB. PSS splits the pages shared
+    with other processes, such as model weights inherited from
+    a preloading master, between them.
+    :param pid: process id
+    :return: None if the process is gone or not readable
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    usage = dict()
+    for line in lines:
+        name, _, value = line.partition(':')
+        if name in MEMORY_FIELDS:
+            usage[MEMORY_FIELDS[name]] = round(int(value.split()[0]) / 1024, 1)
+    return usage
+
+
+def children(pid: int) -> list[int]:
+    """
+    Child processes of a process, empty if unknown
+    :param pid: process id
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
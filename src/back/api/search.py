@@ -1,18 +1,15 @@
 # NOTE: Do not open this file in Open Source Project
 # bc it contains Opscidia's private information.
 
-import re, os
-import numpy as np
-import pandas as pd
-from datetime import datetime
-from elasticsearch_dsl import Q
+import re, os, asyncio, heapq, json, base64, copy, uuid
+from functools import partial
 from itertools import product, chain
-from nltk.corpus import wordnet
-from elasticsearch import AsyncElasticsearch, Elasticsearch
-from elasticsearch_dsl import search as sch, Q
+from models.wordnet import synonyms
+from elasticsearch import AsyncElasticsearch, Elasticsearch, NotFoundError
+from elasticsearch_dsl import search as sch, Q, AsyncSearch, MultiSearch
+from elasticsearch_dsl.response import Response
 from requests import packages
-from typing import List, Optional, Dict, Any, Union
-from shlex import split
+from typing import List, Optional, Dict, Any, Union, Tuple, Iterator, AsyncIterator
 
 packages.urllib3.disable_warnings()
 
@@ -23,55 +20,470 @@ SOURCES = [
     "title", "abstract", "authors", "DOI", "URLs",
     # Add here the fields you want to retrieve from your index
 ]
+MAX_PHRASES = int(os.getenv('QUERY_MAX_PHRASES', '16'))
+PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '10'))
+PIT_KEEP_ALIVE = os.getenv('SEARCH_PIT_KEEP_ALIVE', '5m')
+# true: exact count, false: no count, int: exact count up to this threshold
+TRACK_TOTAL_HITS = os.getenv('ES_TRACK_TOTAL_HITS', 'true').lower()
+TRACK_TOTAL_HITS = (
+    TRACK_TOTAL_HITS == 'true' if TRACK_TOTAL_HITS in ('true', 'false')
+    else int(TRACK_TOTAL_HITS)
+)
 
 
 
-def search_articles(keywords: str, pipeline):
+def prepare_search(keywords: str, augmenter, **options: Any):
     """
-    Search articles to answer questions
+    Augment the question and generate the Elasticsearch query
+    :param keywords: str. question
+    :param augmenter: QueryAugmenter. bounded query augmentation
+    :param options: see `query_generator`
+    :return: augmented keywords and search arguments
     """
-    while True:
-        try:
-            aug_keywords, verbs, k_entities, b_entities, cumulated = augment_query(
-                keywords = keywords,
-                pipeline = pipeline
-            )
-            break
-        except: continue
+    aug_keywords, verbs, k_entities, b_entities, cumulated = augmenter(keywords)
     
     cumulated = re.sub(r'\?', '', cumulated).strip()
-    kwargs = query_generator(verbs, k_entities, b_entities, cumulated)
+    kwargs = query_generator(verbs, k_entities, b_entities, cumulated, **options)
+    return aug_keywords, kwargs
+
+
+
+
+def search_articles(
+    keywords: str,
+    augmenter,
+    connection: 'ESManager',
+    size: int = PAGE_SIZE,
+):
+    """
+    Search articles to answer questions
+    :param keywords: str. question
+    :param augmenter: QueryAugmenter. bounded query augmentation
+    :param connection: ESManager. shared connection pool
+    :param size: int. number of hits
+    """
+    aug_keywords, kwargs = prepare_search(keywords, augmenter, size = size)
     
-    results = articles_results(keywords, aug_keywords, kwargs)
+    results = articles_results(keywords, aug_keywords, kwargs, connection)
     return results
 
 
 
 
+async def async_search_articles(
+    keywords: str,
+    augmenter,
+    connection: 'ESManager',
+    executor,
+    size: int = PAGE_SIZE,
+):
+    """
+    Search articles to answer questions without blocking the event loop.
+    spaCy inference runs in the executor, Elasticsearch is awaited.
+    :param keywords: str. question
+    :param augmenter: QueryAugmenter. bounded query augmentation
+    :param connection: ESManager created with `use_async=True`
+    :param executor: bounded executor for spaCy inference
+    :param size: int. number of hits
+    """
+    loop = asyncio.get_running_loop()
+    aug_keywords, kwargs = await loop.run_in_executor(
+        executor, partial(prepare_search, size = size), keywords, augmenter
+    )
+
+    results = await connection.asearch(**kwargs)
+    return format_results(keywords, aug_keywords, results)
+
+
+
+
+class CursorExpired(Exception):
+    """
+    The state of a paginated search is no longer available
+    """
+
+
+
+
+def search_page(
+    keywords: Optional[str],
+    augmenter,
+    connection: 'ESManager',
+    pages,
+    size: int = PAGE_SIZE,
+    cursor: Optional[str] = None,
+):
+    """
+    Search articles page by page, with point in time and search_after.
+    The first page opens a point in time and stores the augmented query
+    in `pages`, next pages only need the returned cursor.
+    :param keywords: str. question, ignored when a cursor is given
+    :param augmenter: QueryAugmenter. bounded query augmentation
+    :param connection: ESManager. shared connection pool
+    :param pages: cache of augmented queries, see `models.cache`
+    :param size: int. number of hits per page
+    :param cursor: str. cursor of the next page, None for the first page
+    :return: results with the cursor of the next page, None on the last one
+    """
+    if cursor is None:
+        aug_keywords, kwargs = prepare_search(keywords, augmenter, size = size)
+        state = _page_state(pages, keywords, aug_keywords, kwargs)
+        pit, after = connection.open_pit(PIT_KEEP_ALIVE), None
+    else:
+        state, pit, after = _resume_page(pages, cursor)
+
+    try:
+        results = connection.search(**paginate_query(state['kwargs'], pit, after, size))
+    except NotFoundError as e:
+        raise CursorExpired("Point in time expired") from e
+    except Exception:
+        # a point in time opened for this page is not returned: close it
+        if cursor is None:
+            try: connection.close_pit(pit)
+            except Exception: pass
+        raise
+
+    output, pit = _page_output(state, results, size)
+    if output['cursor'] is None: connection.close_pit(pit)
+    return output
+
+
+
+
+async def async_search_page(
+    keywords: Optional[str],
+    augmenter,
+    connection: 'ESManager',
+    executor,
+    pages,
+    size: int = PAGE_SIZE,
+    cursor: Optional[str] = None,
+):
+    """
+    Async `search_page`. spaCy inference and the blocking calls
+    of the page cache run in the executor.
+    :param connection: ESManager created with `use_async=True`
+    :param executor: bounded executor for spaCy inference
+    """
+    loop = asyncio.get_running_loop()
+    if cursor is None:
+        aug_keywords, kwargs = await loop.run_in_executor(
+            executor, partial(prepare_search, size = size), keywords, augmenter
+        )
+        state = await loop.run_in_executor(
+            executor, _page_state, pages, keywords, aug_keywords, kwargs
+        )
+        pit, after = await connection.aopen_pit(PIT_KEEP_ALIVE), None
+    else:
+        state, pit, after = await loop.run_in_executor(
+            executor, _resume_page, pages, cursor
+        )
+
+    try:
+        results = await connection.asearch(**paginate_query(state['kwargs'], pit, after, size))
+    except NotFoundError as e:
+        raise CursorExpired("Point in time expired") from e
+    except Exception:
+        if cursor is None:
+            try: await connection.aclose_pit(pit)
+            except Exception: pass
+        raise
+
+    output, pit = _page_output(state, results, size)
+    if output['cursor'] is None: await connection.aclose_pit(pit)
+    return output
+
+
+
+
+def paginate_query(
+    kwargs: Dict[str, Any],
+    pit: str,
+    after: Optional[List[Any]] = None,
+    size: int = PAGE_SIZE,
+    keep_alive: str = PIT_KEEP_ALIVE,
+) -> Dict[str, Any]:
+    """
+    Search arguments of a page in a point in time
+    :param kwargs: search arguments, see `query_generator`. Not modified
+    :param pit: point in time id
+    :param after: sort values of the last hit of the previous page
+    :param size: number of hits
+    :param keep_alive: point in time extension
+    """
+    kwargs = copy.deepcopy(kwargs)
+    kwargs['sort'] = [{'_score': 'desc'}, {'_shard_doc': 'asc'}]
+    kwargs['extras'].update(
+        size = size,
+        pit = {'id': pit, 'keep_alive': keep_alive},
+    )
+    if after is not None:
+        kwargs['extras']['search_after'] = after
+        # the count is only computed on the first page
+        kwargs['extras']['track_total_hits'] = False
+    return kwargs
+
+
+
+
+def _page_state(pages, keywords, aug_keywords, kwargs) -> Dict[str, Any]:
+    """
+    Private. Store the augmented query of a paginated search
+    """
+    state = dict(
+        id = uuid.uuid4().hex,
+        keywords = keywords,
+        aug_keywords = aug_keywords,
+        kwargs = kwargs,
+    )
+    pages.set(state['id'], state)
+    return state
+
+
+
+
+def _resume_page(pages, cursor: str):
+    """
+    Private. Decode a cursor into the stored state, point in time and sort values
+    """
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        key, pit, after = token['id'], token['pit'], token['after']
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+    state = pages.get(key)
+    if state is None:
+        raise CursorExpired("Search expired")
+    return state, pit, after
+
+
+
+
+def _page_output(state, results, size: int):
+    """
+    Private. Format a page, the cursor points to the next one
+    :return: output and the point in time id to use next
+    """
+    raw = results.to_dict()
+    hits, pit = raw['hits']['hits'], raw.get('pit_id')
+    output = format_results(state['keywords'], state['aug_keywords'], results)
+    output['cursor'] = None if len(hits) < size else base64.urlsafe_b64encode(
+        json.dumps(dict(
+            id = state['id'],
+            pit = pit,
+            after = hits[-1]['sort'],
+        )).encode()
+    ).decode()
+    return output, pit
+
+
+
+
+def export_articles(
+    keywords: str,
+    augmenter,
+    connection: 'ESManager',
+    page_size: int = PAGE_SIZE,
+) -> Iterator[str]:
+    """
+    Stream every hit of a question as NDJSON rows.
+    Hits are walked with point in time and search_after, one page
+    in memory at a time: the next page is only fetched once the rows
+    of the current one have been consumed. The first page is fetched
+    before returning, so that its errors reach the caller before any
+    row is sent; a later failure ends the rows with an error record.
+    :param keywords: str. question
+    :param augmenter: QueryAugmenter. bounded query augmentation
+    :param connection: ESManager. shared connection pool
+    :param page_size: int. hits per Elasticsearch request
+    """
+    aug_keywords, kwargs = prepare_search(
+        keywords, augmenter, size = page_size, track_total_hits = False
+    )
+    pit = connection.open_pit(PIT_KEEP_ALIVE)
+    try:
+        results = connection.search(**paginate_query(kwargs, pit, None, page_size))
+    except Exception:
+        try: connection.close_pit(pit)
+        except Exception: pass
+        raise
+    return _export_rows(connection, kwargs, results, pit, page_size)
+
+
+def _export_rows(connection: 'ESManager', kwargs, results, pit: str, page_size: int):
+    """
+    Private. Rows of the first page and of the following ones
+    """
+    try:
+        while True:
+            hits, pit, after = _export_page(results, pit, page_size)
+            yield from hits
+            if after is None: break
+            results = connection.search(**paginate_query(kwargs, pit, after, page_size))
+    except Exception as e:
+        yield _export_error(e)
+    finally:
+        connection.close_pit(pit)
+
+
+
+
+async def async_export_articles(
+    keywords: str,
+    augmenter,
+    connection: 'ESManager',
+    executor,
+    page_size: int = PAGE_SIZE,
+) -> AsyncIterator[str]:
+    """
+    Async `export_articles`. spaCy inference runs in the executor.
+    :param connection: ESManager created with `use_async=True`
+    :param executor: bounded executor for spaCy inference
+    """
+    loop = asyncio.get_running_loop()
+    aug_keywords, kwargs = await loop.run_in_executor(
+        executor,
+        partial(prepare_search, size = page_size, track_total_hits = False),
+        keywords, augmenter
+    )
+    pit = await connection.aopen_pit(PIT_KEEP_ALIVE)
+    try:
+        results = await connection.asearch(**paginate_query(kwargs, pit, None, page_size))
+    except Exception:
+        try: await connection.aclose_pit(pit)
+        except Exception: pass
+        raise
+    return _aexport_rows(connection, kwargs, results, pit, page_size)
+
+
+async def _aexport_rows(connection: 'ESManager', kwargs, results, pit: str, page_size: int):
+    """
+    Private. Async `_export_rows`
+    """
+    try:
+        while True:
+            hits, pit, after = _export_page(results, pit, page_size)
+            for hit in hits: yield hit
+            if after is None: break
+            results = await connection.asearch(**paginate_query(kwargs, pit, after, page_size))
+    except Exception as e:
+        yield _export_error(e)
+    finally:
+        await connection.aclose_pit(pit)
+
+
+
+
+def _export_page(results, pit: str, page_size: int):
+    """
+    Private. NDJSON rows of a page
+    :return: rows, point in time id and sort values of the last hit,
+        None on the last page
+    """
+    raw = results.to_dict()
+    hits = raw['hits']['hits']
+    rows = [
+        json.dumps(hit) + "\n"
+        for hit in shape_hits(
+            hits,
+            rename = {'highlight': 'highlights', 'abstract': 'content'},
+            drop = ('_index', '_source', 'sort')
+        )
+    ]
+    after = hits[-1]['sort'] if hits and len(hits) == page_size else None
+    return rows, raw.get('pit_id', pit), after
+
+
+def _export_error(e: Exception) -> str:
+    """
+    Private. Last NDJSON row of an export failing after its first page,
+    the response status being already sent
+    """
+    return json.dumps(dict(error = type(e).__name__, detail = str(e))) + "\n"
+
+
+
+
+def search_batch(
+    questions: List[str],
+    augmenter,
+    connection: 'ESManager',
+    batch_size: int = 32,
+) -> List[Dict[str, Any]]:
+    """
+    Search articles for many questions.
+    Questions are augmented in spaCy batches and searched
+    in a single Elasticsearch _msearch round trip.
+    :param questions: list of questions
+    :param augmenter: QueryAugmenter. bounded query augmentation
+    :param connection: ESManager. shared connection pool
+    :param batch_size: spaCy batch size
+    :return: results in input order, with per question errors
+    """
+    if not questions: return []
+    augmented = augmenter.augment_many(questions, batch_size = batch_size)
+    searches = []
+    for aug_keywords, verbs, k_entities, b_entities, cumulated in augmented:
+        cumulated = re.sub(r'\?', '', cumulated).strip()
+        searches.append(query_generator(verbs, k_entities, b_entities, cumulated))
+
+    output = []
+    responses = connection.msearch(searches)
+    for question, (aug_keywords, *_), (results, error) in zip(questions, augmented, responses):
+        output.append({
+            "query": question,
+            "result": format_results(question, aug_keywords, results) if error is None else None,
+            "error": error,
+        })
+    return output
+
+
+
+
 def get_article_by_id(
     id: str,
+    connection: 'ESManager',
+    cache = None,
 ):
     """
     Get article by id
     :param id: str
+    :param connection: ESManager. shared connection pool
+    :param cache: cache of articles by id, see `models.cache`
     """
-    connection = es_connection()
-    kwargs = {"source": SOURCES}
-    results = connection.search(
-        **search_ids_query([id, ], **kwargs)
-    )
-    count = results.hits.total.value
-    if count == 0:
-        return None
-
-    df = pd.DataFrame(map(lambda x: x.to_dict(), results.hits.hits))
-    df = (
-        pd.concat([df, pd.json_normalize(df._source)], axis=1)
-        .drop(columns=['_source', '_index'])
-        .where(lambda x: x.notna(), None)
-    )
+    return get_articles_by_ids([id, ], connection, cache)[0]
 
-    return df.to_dict('records')[0]
+
+
+
+def get_articles_by_ids(
+    ids: List[str],
+    connection: 'ESManager',
+    cache = None,
+) -> List[Optional[Dict[str, Any]]]:
+    """
+    Get articles by ids, in a single search for the ones not in cache
+    :param ids: list of ids
+    :param connection: ESManager. shared connection pool
+    :param cache: cache of articles by id, see `models.cache`
+    :return: articles in input order, None for unknown ids
+    """
+    articles = {
+        id: cache.get(id) if cache is not None else None
+        for id in ids
+    }
+    missing = [id for id, article in articles.items() if article is None]
+    if missing:
+        kwargs = {"source": SOURCES}
+        results = connection.search(
+            **search_ids_query(missing, **kwargs)
+        )
+        for hit in results.to_dict()['hits']['hits']:
+            article = shape_hits([hit, ], drop = ('_source', '_index'))[0]
+            articles[hit['_id']] = article
+            if cache is not None: cache.set(hit['_id'], article)
+
+    return [articles[id] for id in ids]
 
 
 
@@ -82,19 +494,35 @@ def augment_query( keywords: str, pipeline):
     :param query: The query to augment.
     :param pipeline: The spaCy pipeline for query augmentation.
     """
-    if keywords.strip()[-1] != "?": keywords += "?"
-    
-    doc = pipeline(keywords)
+    return augment_doc(pipeline(as_question(keywords)))
+
+
+
+
+def as_question(keywords: str) -> str:
+    """
+    Terminate keywords with a question mark
+    :param keywords: str
+    """
+    if not keywords.strip().endswith("?"): keywords += "?"
+    return keywords
+
+
+
+
+def augment_doc(doc):
+    """
+    Augment a parsed question with synonyms and hypernyms.
+    :param doc: spaCy Doc of the question, see `as_question`.
+    """
     entities = {
         ent.text: [
             ent._.normal_term,
-            ent._.description and re.findall(r"\[\[(.*?)\]\]", ent._.description)[0] or None,
+            next(iter(re.findall(r"\[\[(.*?)\]\]", ent._.description or '')), None),
         ] for ent in doc.ents
     }
     verbs = {
-        ent.text: list({
-            l.lemmas()[0].name() for l in wordnet.synsets(ent.text)
-        }) for ent in doc if ent.pos_ == "VERB"
+        ent.text: synonyms(ent.text) for ent in doc if ent.pos_ == "VERB"
     }
 
     augmented, aug_entities, aug_keywords = [], [], []
@@ -104,32 +532,33 @@ def augment_query( keywords: str, pipeline):
             k_type = token.ent_type_
             entity = token.text
             chunk = token
-            while chunk.nbor().ent_iob == 1:
+            while chunk.i + 1 < len(doc) and chunk.nbor().ent_iob == 1:
                 chunk = chunk.nbor()
                 entity = entity + " " + chunk.text
-            keywords = {
+            # ordered: the entity itself, its normal term, then its alias
+            keywords = dict.fromkeys([
                 entity,
                 *list(filter(
                     bool,
                     entities.get(entity, [None, None])
                 ))
-            }
+            ])
         elif token.pos_ == "VERB":
             k_type = "VERB"
-            keywords = {
+            keywords = dict.fromkeys([
                 token.text,
                 *list(filter(
                     bool,
                     verbs.get(token.text, [None])
                 ))
-            }
-        else: keywords, k_type = {token.text,}, None
+            ])
+        else: keywords, k_type = dict.fromkeys([token.text,]), None
         augmented.append(list(keywords))
         aug_entities.append(list(keywords) if token.ent_type_ else [token.text,])
         aug_keywords.append(dict(keyword=list(keywords), type=k_type))
 
     cumulated = ' '.join(chain(*augmented))
-    b_entities = list(set(map(lambda x: " ".join(x).lower(), product(*aug_entities))))
+    b_entities = expand_phrases(aug_entities, MAX_PHRASES)
 
     k_entities = []
     for keyword, syns in entities.items():
@@ -144,14 +573,55 @@ def augment_query( keywords: str, pipeline):
 
 
 
+def expand_phrases(
+    groups: List[List[str]],
+    limit: Optional[int] = MAX_PHRASES,
+) -> List[str]:
+    """
+    Phrases made of one alternative per group, closest to the question first.
+    Alternatives of a group are ordered by preference, a phrase costs the sum
+    of the ranks of its alternatives. Phrases are enumerated best-first, so
+    only `limit` of them are built instead of the whole Cartesian product.
+    :param groups: alternatives of each token, the original wording first
+    :param limit: max number of phrases, unbounded if None
+    :return: lowercased phrases
+    """
+    if limit is None:
+        return list(set(map(lambda x: " ".join(x).lower(), product(*groups))))
+    if not groups or not all(groups): return []
+
+    phrases = dict()
+    start = (0,) * len(groups)
+    heap, seen = [(0, start)], {start}
+    while heap and len(phrases) < limit:
+        cost, ranks = heapq.heappop(heap)
+        phrase = " ".join(group[rank] for group, rank in zip(groups, ranks))
+        phrases.setdefault(phrase.lower(), None)
+        for i, rank in enumerate(ranks):
+            if rank + 1 < len(groups[i]):
+                follow = ranks[:i] + (rank + 1,) + ranks[i + 1:]
+                if follow not in seen:
+                    seen.add(follow)
+                    heapq.heappush(heap, (cost + 1, follow))
+    return list(phrases)
+
+
+
+
 def query_generator(
     verbs,
     k_entities,
     b_entities,
-    cumulated
+    cumulated,
+    max_phrases: Optional[int] = MAX_PHRASES,
+    size: int = PAGE_SIZE,
+    track_total_hits: Union[bool, int] = TRACK_TOTAL_HITS,
 ):
     """
     Generate query for Elasticsearch
+    :param max_phrases: budget of phrase clauses, unbounded if None
+    :param size: number of hits
+    :param track_total_hits: exact count, or exact count up to a threshold
     """
     # Based on your data structure, you should adapt this function to fit your needs.
     # Here, we are using a simple query with should and must clauses
@@ -167,7 +637,7 @@ def query_generator(
             fields=['title', 'abstract', 'authors'],
             slop=2,
             boost=2
-        ) for query in b_entities
+        ) for query in b_entities[:max_phrases]
     ]
     # Based on your data, you can add more should queries here to boost some specific entities
     
@@ -192,7 +662,8 @@ def query_generator(
         must = must,
         filter = filters,
         should = should,
-        minimum_should_match = 1,
+        # without phrases (degraded augmentation), rely on the must clause only
+        **(dict(minimum_should_match = 1) if should else {}),
     )
 
     highl = Q(
@@ -231,8 +702,8 @@ def query_generator(
         "sources": SOURCES,
         "extras": {
             'from': 0,
-            'size': 10,
-            'track_total_hits': True,
+            'size': size,
+            'track_total_hits': track_total_hits,
         }
     }
 
@@ -243,35 +714,40 @@ def articles_results(
     keywords,
     aug_keywords,
     kwargs,
+    connection,
 ):
     """
     Search articles in Elasticsearch and return results
     """
 
-    connection = es_connection()
-
     results = connection.search(**kwargs)
-    count = results.hits.total.value
+    return format_results(keywords, aug_keywords, results)
 
-    df = pd.DataFrame(map(lambda x: x.to_dict(), results.hits.hits))
-    if not '_source' in df:
-        hits_list = []
-    else:
-        df = (
-            pd.concat([df, pd.json_normalize(df._source)],
-                        axis=1)
-            .rename(columns={'highlight': 'highlights', 'abstract': 'content'})
-            .drop(columns=['_index','_source'])
-            .where(lambda x: x.notnull(), None)
-        )
-        df.drop('_id', axis=1, inplace=True)
-        hits_list = df.to_dict(orient='records')
+
+
+
+def format_results(
+    keywords,
+    aug_keywords,
+    results,
+):
+    """
+    Format Elasticsearch response for the API
+    """
+    raw = results.to_dict()
+    total = raw['hits'].get('total', {})
+
+    hits_list = shape_hits(
+        raw['hits']['hits'],
+        rename = {'highlight': 'highlights', 'abstract': 'content'},
+        drop = ('_index', '_source', '_id', 'sort')
+    )
     
     output = {
         "hits": hits_list,
         "stats": {
-            "value": count,
-            "relation": "eq",
+            "value": total.get('value'),
+            "relation": total.get('relation'),
             "took": results.took,
         },
         "query": {
@@ -288,6 +764,59 @@ def articles_results(
 
 
 
+def shape_hits(
+    hits: List[Dict[str, Any]],
+    rename: Dict[str, str] = {},
+    drop: Tuple[str, ...] = (),
+) -> List[Dict[str, Any]]:
+    """
+    Flatten raw Elasticsearch hits into response records.
+    `_source` fields are merged into the hit, nested objects are flattened
+    with dotted keys, and every record gets the keys of all records,
+    missing values being None.
+
+    :param hits: raw `hits.hits` of the response
+    :param rename: keys to rename
+    :param drop: keys to drop, after renaming
+    :return: list of records, empty if no hit has a `_source`
+    """
+    if not any('_source' in hit for hit in hits): return []
+
+    sources = [_flatten(hit.get('_source') or {}) for hit in hits]
+    columns = dict.fromkeys(chain(
+        chain.from_iterable(hits),
+        chain.from_iterable(sources)
+    ))
+    columns = [
+        (key, rename.get(key, key)) for key in columns
+        if rename.get(key, key) not in drop
+    ]
+    return [
+        {
+            name: hit[key] if key in hit else source.get(key)
+            for key, name in columns
+        }
+        for hit, source in zip(hits, sources)
+    ]
+
+
+
+
+def _flatten(source: Dict[str, Any], prefix: str = '') -> Dict[str, Any]:
+    """
+    Private. Flatten nested objects with dotted keys
+    """
+    flat = {}
+    for key, value in source.items():
+        if isinstance(value, dict) and value:
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+
+
 class ESManager(object):
     """
     To use for holding connections to elasticsearch clusters.
@@ -299,7 +828,15 @@ class ESManager(object):
         password='password',
         verify_certs=True,
         timeout=160,
-        use_async=False):
+        use_async=False,
+        pool_size=10,
+        keep_alive=True,
+        sniff=False,
+        sniff_interval=60.0,
+        max_retries=3,
+        retry_on_timeout=True,
+        backoff_factor=1.0,
+        max_backoff=30.0):
         """
         Init Elastic search manager.
 
@@ -308,8 +845,27 @@ class ESManager(object):
         :param secret_key (str, optional): secret key
         :param region (str, optional): region
         :param service (str):
+        :param pool_size (int): connections kept open per node
+        :param keep_alive (bool): reuse connections between requests
+        :param sniff (bool): discover cluster nodes on start and on failure
+        :param sniff_interval (float): min seconds between two sniffs
+        :param max_retries (int): retries of a failed request
+        :param retry_on_timeout (bool): also retry requests that timed out
+        :param backoff_factor (float): dead node backoff factor, in seconds
+        :param max_backoff (float): max dead node backoff, in seconds
         """
         self.auth = username, password
+        pool = dict(
+            connections_per_node = pool_size,
+            headers = {'Connection': 'keep-alive' if keep_alive else 'close'},
+            sniff_on_start = sniff,
+            sniff_on_node_failure = sniff,
+            min_delay_between_sniffing = sniff_interval,
+            max_retries = max_retries,
+            retry_on_timeout = retry_on_timeout,
+            dead_node_backoff_factor = backoff_factor,
+            max_dead_node_backoff = max_backoff,
+        )
 
         if not use_async:
             self.connect = Elasticsearch(
@@ -317,6 +873,7 @@ class ESManager(object):
                 timeout=timeout,
                 http_auth = self.auth,
                 verify_certs = False,
+                **pool
             )
         else:
             self.connect = AsyncElasticsearch(
@@ -324,14 +881,16 @@ class ESManager(object):
                 timeout=timeout,
                 http_auth = self.auth,
                 verify_certs = verify_certs,
+                **pool
             )
         self.index = os.environ.get('ES_INDEX')
 
 
 
 
-    def search(
+    def _search(
         self,
+        search_class: type,
         index: str = '',
         query: Q = None,
         sources: List = [],
@@ -341,8 +900,9 @@ class ESManager(object):
         **kwargs: Any
     ):
         """
-        Execute search query.
+        Private. Build search query.
 
+        :param search_class: (type) Search or AsyncSearch
         :param index: (str) index name
         :param query: (Dict) query
         :param sources: (List) sources
@@ -350,8 +910,9 @@ class ESManager(object):
         :param sort: (List[Any]) list of dicts or str
         :param extras: (Dict) extras
         """
-        self.index = index if len(index.strip()) > 0 else self.index
-        _s = sch.Search(using=self.connect, index = self.index).extra(**extras).query(query)
+        index = index if len(index.strip()) > 0 else self.index
+        if 'pit' in extras: index = None
+        _s = search_class(using=self.connect, index = index).extra(**extras).query(query)
         
         if len(highlight.keys()):
             fields = highlight.pop('fields', {})
@@ -362,10 +923,117 @@ class ESManager(object):
         if len(sources) > 0: _s = _s.source(sources)
         if sort: _s = _s.sort(*sort)
 
-        resp = _s.execute(ignore_cache=False)
+        return _s
+
+
+    def search(self, **kwargs: Any):
+        """
+        Execute search query.
+        See `ESManager._search` for the arguments.
+        """
+        resp = self._search(sch.Search, **kwargs).execute(ignore_cache=False)
 
         return resp
-    
+
+
+    async def asearch(self, **kwargs: Any):
+        """
+        Execute search query with AsyncElasticsearch.
+        Requires a manager created with `use_async=True`.
+        See `ESManager._search` for the arguments.
+        """
+        resp = await self._search(AsyncSearch, **kwargs).execute(ignore_cache=False)
+
+        return resp
+
+
+    def open_pit(self, keep_alive: str = PIT_KEEP_ALIVE, index: str = '') -> str:
+        """
+        Open a point in time.
+
+        :param keep_alive: (str) duration, e.g. 5m
+        :param index: (str) index name
+        :return: (str) point in time id
+        """
+        index = index if len(index.strip()) > 0 else self.index
+        return self.connect.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+
+
+    async def aopen_pit(self, keep_alive: str = PIT_KEEP_ALIVE, index: str = '') -> str:
+        """
+        Async `ESManager.open_pit`.
+        """
+        index = index if len(index.strip()) > 0 else self.index
+        return (await self.connect.open_point_in_time(index=index, keep_alive=keep_alive))['id']
+
+
+    def close_pit(self, pit: str):
+        """
+        Close a point in time, ignore expired ones.
+
+        :param pit: (str) point in time id
+        """
+        return self.connect.options(ignore_status=404).close_point_in_time(id=pit)
+
+
+    async def aclose_pit(self, pit: str):
+        """
+        Async `ESManager.close_pit`.
+        """
+        return await self.connect.options(ignore_status=404).close_point_in_time(id=pit)
+
+
+    def msearch(self, searches: List[Dict[str, Any]]):
+        """
+        Execute many search queries in a single round trip.
+        See `ESManager._search` for the arguments of each query.
+
+        :param searches: (List) search arguments
+        :return: (List) (response, None) or (None, error) for each query
+        """
+        _searches = [self._search(sch.Search, **kwargs) for kwargs in searches]
+        _ms = MultiSearch(using=self.connect, index=self.index)
+        for _s in _searches: _ms = _ms.add(_s)
+
+        resp = self.connect.msearch(index=self.index, body=_ms.to_dict())
+
+        return [
+            (None, r['error']) if r.get('error') else (Response(_s, r), None)
+            for _s, r in zip(_searches, resp['responses'])
+        ]
+
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        Connection reuse statistics for each node of the pool.
+        Counters are only available for the synchronous (urllib3) nodes.
+
+        :return: (List) one dict per node
+        """
+        stats = []
+        for node in self.connect.transport.node_pool.all():
+            pool = getattr(node, 'pool', None)
+            requests = getattr(pool, 'num_requests', None)
+            connections = getattr(pool, 'num_connections', None)
+            stats.append({
+                "node": str(node.base_url),
+                "requests": requests,
+                "connections": connections,
+                "reused": (
+                    requests - connections
+                    if requests is not None and connections is not None
+                    else None
+                ),
+            })
+        return stats
+
+
+    def close(self):
+        """
+        Close all the connections of the pool.
+        Must be awaited for managers created with `use_async=True`.
+        """
+        return self.connect.close()
 
 
 
@@ -373,20 +1041,35 @@ def es_connection(
     login: Optional[str] = os.environ.get('ES_LOGIN'),
     password: Optional[str] = os.environ.get('ES_PASSWORD'),
     host: Optional[str] = os.environ.get('ES_HOST'),
-    verify: Optional[bool] = True
+    verify: Optional[bool] = True,
+    use_async: bool = False,
 ) -> ESManager:
     """
-    Create ESManager connection
+    Create ESManager connection.
+    Meant to be called once per process, the returned manager
+    holds the connection pool shared by all requests.
+    Pool settings are read from the ES_POOL_SIZE, ES_KEEP_ALIVE, ES_SNIFF,
+    ES_SNIFF_INTERVAL, ES_MAX_RETRIES, ES_RETRY_ON_TIMEOUT, ES_BACKOFF_FACTOR
+    and ES_MAX_BACKOFF environment variables.
     :param login: str. Defaut to global variable ES_LOGIN
     :param password: str. Defaut to global variable ES_PASSWORD
     :param host: str. Defaut to global variable ES_HOST
     :param verify: bool. Verify SSL certs. Defaut to True
+    :param use_async: bool. Use AsyncElasticsearch. Default to False
     :return: ESManager object
     """
     es_login, es_passwd, es_host = login, password, host
     connection = ESManager(
         hosts=es_host, username=es_login, password=es_passwd,
-        use_async=False, verify_certs=verify
+        use_async=use_async, verify_certs=verify,
+        pool_size = int(os.getenv('ES_POOL_SIZE', '10')),
+        keep_alive = os.getenv('ES_KEEP_ALIVE', '1') == '1',
+        sniff = os.getenv('ES_SNIFF', '0') == '1',
+        sniff_interval = float(os.getenv('ES_SNIFF_INTERVAL', '60')),
+        max_retries = int(os.getenv('ES_MAX_RETRIES', '3')),
+        retry_on_timeout = os.getenv('ES_RETRY_ON_TIMEOUT', '1') == '1',
+        backoff_factor = float(os.getenv('ES_BACKOFF_FACTOR', '1')),
+        max_backoff = float(os.getenv('ES_MAX_BACKOFF', '30')),
     )
     return connection
 
@@ -406,6 +1089,7 @@ def search_ids_query(
     return {
         'query': Q('ids', values=[str(x) for x in ids]).to_dict(),
         'sources': kwargs.get('source', SOURCES),
+        'extras': {'size': len(ids)},
     }
 
 
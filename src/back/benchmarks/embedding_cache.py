@@ -0,0 +1,67 @@
+"""
+Size and latency of cached embeddings: JSON lists versus binary float32 and float16.
+
+    python -m benchmarks.embedding_cache --articles 10000 --redis
+
+Without --redis, only serialization is measured. With --redis, vectors are
+written to and read from the Redis service under the `bench:` prefix.
+"""
+import argparse, json, time
+import numpy as np
+from models.cache import encode_embedding, decode_embedding
+from models.utils import redis_connection
+
+
+
+
+FORMATS = {
+    "json": (lambda v: json.dumps(v.tolist()), lambda b: json.loads(b)),
+    "float32": (lambda v: encode_embedding(v, "float32"), decode_embedding),
+    "float16": (lambda v: encode_embedding(v, "float16"), decode_embedding),
+}
+
+
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, (time.perf_counter() - start) * 1e3
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--articles", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--batch", type=int, default=20, help="ids per mget, like a selection")
+    parser.add_argument("--redis", action="store_true")
+    args = parser.parse_args()
+
+    vectors = np.random.randn(args.articles, args.dim).astype(np.float32)
+    client = redis_connection(decode_responses = False) if args.redis else None
+    print(f"{'format':>8} {'MB':>8} {'encode (ms)':>12} {'decode (ms)':>12} {'redis MB':>9} {'mget (ms)':>10}")
+    for name, (encode, decode) in FORMATS.items():
+        values, encoding = timed(lambda: [encode(v) for v in vectors])
+        _, decoding = timed(lambda: [decode(v if isinstance(v, bytes) else v.encode()) for v in values])
+        size = sum(map(len, values)) / 2 ** 20
+        used, mget = "-", "-"
+        if client is not None:
+            keys = [f"bench:{name}:{i}" for i in range(args.articles)]
+            before = client.info("memory")["used_memory"]
+            for i in range(0, args.articles, 1000):
+                client.mset(dict(zip(keys[i:i + 1000], values[i:i + 1000])))
+            used = f"{(client.info('memory')['used_memory'] - before) / 2 ** 20:.1f}"
+            batches = [keys[i:i + args.batch] for i in range(0, args.articles, args.batch)]
+            _, total = timed(lambda: [[decode(v) for v in client.mget(batch)] for batch in batches])
+            mget = f"{total / len(batches):.3f}"
+            for i in range(0, args.articles, 1000):
+                client.delete(*keys[i:i + 1000])
+        print(f"{name:>8} {size:>8.1f} {encoding:>12.1f} {decoding:>12.1f} {used:>9} {mget:>10}")
+
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Entity linking latency: the entityfishing component versus
+`models.components.CachedEntityFishing`, cold and on cache hits.
+
+    python -m benchmarks.entity_linking --latency 50 --questions 32
+
+Both run against a local stub of the entity-fishing API answering after
+`--latency` ms, so that the numbers do not depend on the remote service.
+"""
+import argparse, email, json, os, random, statistics, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import spacy
+from models.components import CachedEntityFishing
+
+TERMS = [
+    "aspirin", "colorectal cancer", "vitamin D", "influenza", "metformin",
+    "type 2 diabetes", "statins", "myalgia", "coffee", "hypertension",
+    "ibuprofen", "asthma", "melatonin", "insomnia", "zinc", "common cold",
+]
+
+
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Links every mention of a disambiguation request, after a delay
+    """
+    latency = 0.05
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = email.message_from_bytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        query = json.loads(next(
+            part.get_payload(decode = True) for part in message.walk()
+            if part.get_param('name', header = 'content-disposition') == 'query'
+        ))
+        time.sleep(self.latency)
+        entities = [
+            {
+                **entity,
+                "wikidataId": f"Q{abs(hash(entity['rawName'])) % 10**6}",
+                "wikipediaExternalRef": abs(hash(entity['rawName'])) % 10**6,
+                "confidence_score": 0.9,
+                "preferredTerm": entity['rawName'].title(),
+                "definitions": [{
+                    "definition": f"'''{entity['rawName']}''' is a [[{entity['rawName']}]]",
+                    "source": "wikipedia-en",
+                    "lang": "en",
+                }],
+            }
+            for entity in query['entities']
+        ]
+        payload = json.dumps({"entities": entities}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+
+
+def pipeline(component: str, url: str, **config):
+    """
+    Blank English pipeline finding the terms, then linking them
+    """
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns([{"label": "ENTITY", "pattern": term} for term in TERMS])
+    nlp.add_pipe(component, name = "entityfishing", config = {
+        "api_ef_base": url, "extra_info": True, **config
+    })
+    return nlp
+
+
+def questions(size: int) -> list[str]:
+    return [
+        f"Does {random.choice(TERMS)} reduce the risk of {random.choice(TERMS)}?"
+        for _ in range(size)
+    ]
+
+
+def per_question(nlp, texts: list[str]) -> float:
+    """
+    Median ms of linking questions one at a time
+    """
+    times = list()
+    for text in texts:
+        start = time.perf_counter()
+        nlp(text)
+        times.append((time.perf_counter() - start) * 1e3)
+    return statistics.median(times)
+
+
+def batch(nlp, texts: list[str]) -> float:
+    """
+    ms of linking questions with nlp.pipe
+    """
+    start = time.perf_counter()
+    list(nlp.pipe(texts, batch_size = len(texts)))
+    return (time.perf_counter() - start) * 1e3
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type = float, default = 50, help = "stub latency in ms")
+    parser.add_argument("--questions", type = int, default = 32)
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+    texts = questions(args.questions)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cached = lambda name: pipeline(
+            "cached_entityfishing", url, cache_path = os.path.join(tmp, f"{name}.sqlite")
+        )
+        upstream = pipeline("entityfishing", url)
+
+        print(f"{'':>28} {'ms':>9}")
+        print(f"{'entityfishing per question':>28} {per_question(upstream, texts):>9.2f}")
+        print(f"{'cached, first pass':>28} {per_question(cached('questions'), texts):>9.2f}")
+        # a new component starts with an empty memory tier
+        nlp = cached('questions')
+        print(f"{'cached, SQLite hit':>28} {per_question(nlp, texts):>9.2f}")
+        print(f"{'cached, memory hit':>28} {per_question(nlp, texts):>9.2f}")
+
+        print(f"{'entityfishing pipe':>28} {batch(upstream, texts):>9.2f}")
+        print(f"{'cached pipe, cold':>28} {batch(cached('pipe'), texts):>9.2f}")
+    server.shutdown()
+
+
+
+
+if __name__ == "__main__":
+    main()
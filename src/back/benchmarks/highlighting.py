@@ -0,0 +1,140 @@
+"""
+Formatting of EQA predictions on a selection of articles:
+the former pandas path versus `models.utils.EQA._qa_format`.
+
+    python -m benchmarks.highlighting --documents 50 --answers 10
+
+The pandas path needs the benchmark requirements:
+
+    pip install -r benchmarks/requirements.txt
+"""
+import argparse, random, timeit
+from dataclasses import dataclass
+import pandas as pd
+from models.utils import EQA
+
+
+
+
+@dataclass
+class Span:
+    start: int
+    end: int
+
+
+@dataclass
+class Answer:
+    answer: str
+    context: str
+    score: float
+    document_ids: list[str]
+    offsets_in_document: list[Span]
+    offsets_in_context: list[Span]
+
+
+@dataclass
+class Document:
+    id: str
+    score: float
+
+
+
+
+def pandas_format(articles: list[dict], predictions: dict) -> list[dict]:
+    """
+    Former implementation of `EQA._qa_format`
+    """
+    def highlight_answer(row: pd.Series) -> str:
+        content = row['content']
+        contexts = row['context']
+        answers = row['answer']
+        scores = row['anscore']
+        if not isinstance(contexts, list):
+            return content
+        for context, answer, score in zip(contexts, answers, scores):
+            score = f'{score:.2f}%'
+            content = content.replace(context, f'<span class="hglt__context">{context}</span>')
+            content = content.replace(answer, f'<span class="hglt__answer" score="{score}">{answer}</span>')
+        return content
+
+    answers = (
+        pd.DataFrame(
+            predictions['answers'],
+            columns=['document_ids', 'score', 'context', 'answer']
+        )
+        .explode('document_ids')
+        .rename(columns={'document_ids': 'id'})
+        .assign(anscore = lambda x: x['score'] * 100)
+        .drop(columns=['score'])
+        .groupby('id')
+        .agg(list)
+        .reset_index()
+    )
+    results = (
+        pd.DataFrame(articles)
+        .merge(
+            pd.DataFrame(predictions['documents'], columns=['id', 'score']),
+            on = 'id',
+            how = 'left'
+        )
+        .assign(score = lambda x: x['score'].fillna(0) * 100)
+        .merge(answers, on = 'id', how = 'left')
+        .fillna('[]')
+        .assign(content = lambda x: x.apply(highlight_answer, axis=1))
+        .sort_values('score', ascending=False)
+    )
+    return results.to_dict(orient='records')
+
+
+
+
+def selection(documents: int, answers: int, words: int = 300):
+    """
+    Articles and reader predictions of a synthetic selection,
+    answers are spread over the 5 ranked documents
+    """
+    vocabulary = [f"w{i}" for i in range(5000)]
+    articles = [
+        {"id": str(i), "title": f"article {i}", "content": " ".join(random.choices(vocabulary, k=words))}
+        for i in range(documents)
+    ]
+    ranked = random.sample(articles, k=min(5, documents))
+    predictions = {"documents": [Document(a["id"], random.random()) for a in ranked], "answers": []}
+    for _ in range(answers):
+        article = random.choice(ranked)
+        tokens = article["content"].split()
+        i = random.randrange(10, len(tokens) - 20)
+        context = " ".join(tokens[i - 10:i + 15])
+        answer = " ".join(tokens[i:i + 3])
+        context_start = article["content"].index(context)
+        start = context_start + context.index(answer)
+        predictions["answers"].append(Answer(
+            answer, context, random.random(), [article["id"]],
+            [Span(start, start + len(answer))],
+            [Span(start - context_start, start - context_start + len(answer))],
+        ))
+    return articles, predictions
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--answers", type=int, nargs="+", default=[1, 5, 10, 20])
+    parser.add_argument("--number", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'answers':>8} {'pandas (ms)':>12} {'offsets (ms)':>13} {'speedup':>8}")
+    for answers in args.answers:
+        articles, predictions = selection(args.documents, answers)
+        slow = min(timeit.repeat(lambda: pandas_format(articles, predictions), number=args.number, repeat=3))
+        fast = min(timeit.repeat(lambda: EQA._qa_format(articles, predictions), number=args.number, repeat=3))
+        slow, fast = slow / args.number * 1e3, fast / args.number * 1e3
+        print(f"{answers:>8} {slow:>12.3f} {fast:>13.3f} {slow / fast:>7.1f}x")
+
+
+
+
+if __name__ == "__main__":
+    main()
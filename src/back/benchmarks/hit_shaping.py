@@ -0,0 +1,93 @@
+"""
+Shaping of Elasticsearch hits into /api/search records:
+the former pandas path versus `api.search.shape_hits`.
+
+    python -m benchmarks.hit_shaping --sizes 10 100 1000
+
+The pandas path needs the benchmark requirements:
+
+    pip install -r benchmarks/requirements.txt
+"""
+import argparse, random, timeit
+import pandas as pd
+from api.search import shape_hits
+
+
+
+
+def pandas_hits(hits: list[dict]) -> list[dict]:
+    """
+    Former implementation of `api.search.format_results`
+    """
+    df = pd.DataFrame(hits)
+    if not '_source' in df:
+        return []
+    df = (
+        pd.concat([df, pd.json_normalize(df._source)],
+                    axis=1)
+        .rename(columns={'highlight': 'highlights', 'abstract': 'content'})
+        .drop(columns=['_index','_source'])
+        .where(lambda x: x.notnull(), None)
+    )
+    df.drop('_id', axis=1, inplace=True)
+    return df.to_dict(orient='records')
+
+
+
+
+def direct_hits(hits: list[dict]) -> list[dict]:
+    return shape_hits(
+        hits,
+        rename = {'highlight': 'highlights', 'abstract': 'content'},
+        drop = ('_index', '_source', '_id')
+    )
+
+
+
+
+def fake_hits(size: int) -> list[dict]:
+    words = "aspirin reduces the risk of ulcer in patients with chronic pain".split()
+    sentence = lambda n: " ".join(random.choices(words, k=n))
+    return [
+        {
+            "_index": "articles",
+            "_id": str(i),
+            "_score": random.random() * 20,
+            "_source": {
+                "title": sentence(10),
+                "abstract": sentence(200),
+                "authors": [sentence(2) for _ in range(4)],
+                "DOI": f"10.1000/{i}",
+                "URLs": [f"https://doi.org/10.1000/{i}"],
+            },
+            "highlight": {
+                "title": [sentence(10)],
+                "abstract": [sentence(15) for _ in range(4)],
+            },
+        }
+        for i in range(size)
+    ]
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--number", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'hits':>6} {'pandas (ms)':>12} {'direct (ms)':>12} {'speedup':>8}")
+    for size in args.sizes:
+        hits = fake_hits(size)
+        assert pandas_hits(hits) == direct_hits(hits)
+        slow = min(timeit.repeat(lambda: pandas_hits(hits), number=args.number, repeat=3))
+        fast = min(timeit.repeat(lambda: direct_hits(hits), number=args.number, repeat=3))
+        slow, fast = slow / args.number * 1e3, fast / args.number * 1e3
+        print(f"{size:>6} {slow:>12.3f} {fast:>12.3f} {slow / fast:>7.1f}x")
+
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Accuracy and latency of the int8 ONNX Runtime backend
+against the PyTorch backend, on a fixed question set.
+
+    python -m benchmarks.onnx_backend --repeat 5
+
+Accuracy is the agreement with the PyTorch outputs: cosine similarity of
+the embeddings, same top document for the ranker, same best answer for
+the reader. Models are exported on the first run.
+"""
+import argparse, statistics, time
+import numpy as np
+from haystack.nodes import FARMReader, SentenceTransformersRanker
+from haystack.schema import Document
+from models.components import OnnxFARMReader, OnnxSentenceTransformersRanker
+from models.utils import dense_retriever, DENSE_MODEL, RANKER_MODEL, READER_MODEL
+
+QUESTIONS = [
+    (
+        "Does aspirin reduce the risk of colorectal cancer?",
+        [
+            "Long-term daily aspirin use was associated with a reduced incidence of colorectal cancer in randomised trials of cardiovascular prevention.",
+            "Aspirin irreversibly inhibits cyclooxygenase, reducing the synthesis of prostaglandins and thromboxanes.",
+            "Gastrointestinal bleeding is the most frequent adverse effect of low-dose aspirin in older adults.",
+        ],
+    ),
+    (
+        "Is vitamin D supplementation effective against respiratory infections?",
+        [
+            "A meta-analysis of individual participant data found that vitamin D supplementation reduced the risk of acute respiratory infection, mainly in participants with low baseline levels.",
+            "Vitamin D is synthesised in the skin under ultraviolet B radiation and hydroxylated in the liver and kidney.",
+            "Respiratory syncytial virus is a leading cause of hospitalisation in infants.",
+        ],
+    ),
+    (
+        "Does regular physical activity lower blood pressure?",
+        [
+            "Aerobic exercise training reduced systolic blood pressure by about 4 mmHg in normotensive and hypertensive adults.",
+            "Hypertension affects more than a billion people worldwide and is a major risk factor for stroke.",
+            "Sedentary behaviour was measured by accelerometers worn for seven consecutive days.",
+        ],
+    ),
+    (
+        "Can metformin prevent type 2 diabetes?",
+        [
+            "In the Diabetes Prevention Program, metformin reduced the incidence of type 2 diabetes by 31 percent compared with placebo.",
+            "Metformin lowers hepatic glucose production and is the first-line treatment of type 2 diabetes.",
+            "Lifestyle intervention was more effective than metformin in preventing diabetes in older participants.",
+        ],
+    ),
+    (
+        "Do statins cause muscle pain?",
+        [
+            "In blinded trials, muscle symptoms were reported at similar rates by participants taking statins and placebo.",
+            "Statins inhibit HMG-CoA reductase and lower low-density lipoprotein cholesterol.",
+            "Rhabdomyolysis is a rare but serious complication of statin therapy.",
+        ],
+    ),
+    (
+        "Does coffee consumption increase the risk of heart disease?",
+        [
+            "Moderate coffee consumption of three to five cups per day was associated with a lower risk of cardiovascular disease.",
+            "Caffeine is an adenosine receptor antagonist that increases alertness.",
+            "Unfiltered coffee contains diterpenes that raise serum cholesterol.",
+        ],
+    ),
+]
+
+
+
+
+def timed(fn, repeat: int):
+    """
+    Median latency in ms of `fn` and its last output
+    """
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = fn()
+        times.append((time.perf_counter() - start) * 1e3)
+    return statistics.median(times), output
+
+
+def documents(passages: list[str]) -> list[Document]:
+    return [Document(id = str(i), content = passage) for i, passage in enumerate(passages)]
+
+
+
+
+def dense(repeat: int):
+    torch, onnx = dense_retriever(DENSE_MODEL, 'torch'), dense_retriever(DENSE_MODEL, 'onnx')
+    passages = documents([p for _, passages in QUESTIONS for p in passages])
+    rows = dict()
+    for name, retriever in (("torch", torch), ("onnx", onnx)):
+        rows[name] = timed(lambda: retriever.embed_documents(passages), repeat)
+    a, b = np.asarray(rows["torch"][1]), np.asarray(rows["onnx"][1])
+    cosine = (a * b).sum(1) / np.linalg.norm(a, axis = 1) / np.linalg.norm(b, axis = 1)
+    return rows["torch"][0], rows["onnx"][0], f"cosine {cosine.mean():.4f} (min {cosine.min():.4f})"
+
+
+def ranker(repeat: int):
+    kwargs = dict(model_name_or_path = RANKER_MODEL, use_gpu = False, top_k = 3)
+    torch, onnx = SentenceTransformersRanker(**kwargs), OnnxSentenceTransformersRanker(**kwargs)
+    queries = [question for question, _ in QUESTIONS]
+    docs = [documents(passages) for _, passages in QUESTIONS]
+    rows = dict()
+    for name, model in (("torch", torch), ("onnx", onnx)):
+        rows[name] = timed(lambda: model.predict_batch(queries = queries, documents = docs), repeat)
+    same = [a[0].id == b[0].id for a, b in zip(rows["torch"][1], rows["onnx"][1])]
+    return rows["torch"][0], rows["onnx"][0], f"top document {sum(same)}/{len(same)}"
+
+
+def reader(repeat: int):
+    kwargs = dict(model_name_or_path = READER_MODEL, use_gpu = False, max_seq_len = 512, top_k = 1)
+    torch, onnx = FARMReader(**kwargs), OnnxFARMReader(**kwargs)
+    queries = [question for question, _ in QUESTIONS]
+    docs = [documents(passages) for _, passages in QUESTIONS]
+    rows = dict()
+    for name, model in (("torch", torch), ("onnx", onnx)):
+        rows[name] = timed(lambda: model.predict_batch(queries = queries, documents = docs)['answers'], repeat)
+    best = lambda answers: answers[0].answer if answers else None
+    same = [best(a) == best(b) for a, b in zip(rows["torch"][1], rows["onnx"][1])]
+    return rows["torch"][0], rows["onnx"][0], f"best answer {sum(same)}/{len(same)}"
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type = int, default = 5)
+    args = parser.parse_args()
+
+    print(f"{'model':>7} {'torch (ms)':>11} {'onnx (ms)':>10} {'speedup':>8}  agreement")
+    for name, bench in (("dense", dense), ("ranker", ranker), ("reader", reader)):
+        slow, fast, agreement = bench(args.repeat)
+        print(f"{name:>7} {slow:>11.1f} {fast:>10.1f} {slow / fast:>7.1f}x  {agreement}")
+
+
+
+
+if __name__ == "__main__":
+    main()
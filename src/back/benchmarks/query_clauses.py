@@ -0,0 +1,65 @@
+"""
+Phrase clauses and Elasticsearch `took` versus the number of entities.
+
+    python -m benchmarks.query_clauses --entities 8 --synonyms 3
+
+Clause counts are computed offline. ES `took` is measured when ES_HOST is set.
+"""
+import argparse, os, statistics
+from api.search import (
+    expand_phrases,
+    query_generator,
+    es_connection,
+)
+
+
+
+
+def question(entities: int, synonyms: int) -> list[list[str]]:
+    """
+    Token groups of a synthetic question with `entities` entities
+    having `synonyms` alternatives each
+    """
+    groups = [["does"]]
+    for i in range(entities):
+        groups.append([f"entity{i}"] + [f"entity{i} synonym{j}" for j in range(synonyms - 1)])
+        groups.append(["and"] if i < entities - 2 else ["cause"])
+    return groups[:-1] + [["?"]]
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, default=8)
+    parser.add_argument("--synonyms", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    connection = es_connection() if os.getenv('ES_HOST') else None
+    print(f"{'entities':>8} {'strategy':>9} {'clauses':>8} {'took (ms)':>10}")
+    for n in range(1, args.entities + 1):
+        groups = question(n, args.synonyms)
+        cumulated = " ".join(word for group in groups for word in group)
+        for strategy, limit in (("product", None), ("budget", args.limit)):
+            phrases = expand_phrases(groups, limit)
+            took = "-"
+            if connection is not None:
+                try:
+                    took = statistics.median(
+                        connection.search(
+                            **query_generator({}, [], phrases, cumulated, max_phrases=None)
+                        ).took
+                        for _ in range(args.repeat)
+                    )
+                except Exception as e:
+                    took = type(e).__name__
+            print(f"{n:>8} {strategy:>9} {len(phrases):>8} {took:>10}")
+    if connection is not None: connection.close()
+
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Startup time, memory and questions/sec of the query parsing profiles,
+see `models.utils.TOKEN_PROFILES`.
+
+    python -m benchmarks.token_profiles --profiles full lean small
+
+Each profile loads in a fresh process, without entity-fishing. Agreement
+is the share of questions whose `augment_doc` output equals the full profile's.
+"""
+import argparse, multiprocessing, resource, time
+
+QUESTIONS = [
+    "Does aspirin reduce the risk of colorectal cancer?",
+    "Is vitamin D supplementation effective against respiratory infections?",
+    "Does regular physical activity lower blood pressure in older adults?",
+    "Can metformin prevent type 2 diabetes in prediabetic patients?",
+    "Do statins cause muscle pain?",
+    "Does coffee consumption increase the risk of heart disease?",
+    "Is melatonin effective for treating insomnia?",
+    "Does zinc shorten the duration of the common cold?",
+    "Can omega-3 fatty acids prevent cardiovascular events?",
+    "Does the BCG vaccine protect against COVID-19?",
+    "Do proton pump inhibitors increase the risk of dementia?",
+    "Is intermittent fasting effective for weight loss?",
+]
+
+
+
+
+def run(profile: str, repeat: int):
+    """
+    Load a profile and parse the questions, in a fresh process
+    :return: startup seconds, questions/sec, max RSS in MB, augmentations
+    """
+    from models.utils import token_pipeline
+    start = time.perf_counter()
+    nlp = token_pipeline(profile, linker = False)
+    startup = time.perf_counter() - start
+
+    from api.search import augment_doc
+    questions = QUESTIONS * repeat
+    start = time.perf_counter()
+    augmented = [augment_doc(doc) for doc in nlp.pipe(questions)]
+    rate = len(questions) / (time.perf_counter() - start)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return startup, rate, rss, augmented[:len(QUESTIONS)]
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs = "+", default = ["full", "lean", "small"])
+    parser.add_argument("--repeat", type = int, default = 10)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    results = dict()
+    for profile in args.profiles:
+        with context.Pool(1) as pool:
+            results[profile] = pool.apply(run, (profile, args.repeat))
+
+    reference = results.get("full", next(iter(results.values())))[3]
+    print(f"{'profile':>8} {'startup (s)':>12} {'questions/s':>12} {'RSS (MB)':>9} {'agreement':>10}")
+    for profile, (startup, rate, rss, augmented) in results.items():
+        same = sum(a == b for a, b in zip(augmented, reference))
+        print(f"{profile:>8} {startup:>12.2f} {rate:>12.1f} {rss:>9.0f} {same:>6}/{len(reference)}")
+
+
+
+
+if __name__ == "__main__":
+    main()
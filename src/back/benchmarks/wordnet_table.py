@@ -0,0 +1,86 @@
+"""
+Startup, memory and lookup latency of the verb synonyms:
+NLTK WordNet versus the table of `models.wordnet`.
+
+    python -m benchmarks.wordnet_table
+
+Each variant loads in a fresh process, memory is the RSS growth of the load.
+"""
+import argparse, multiprocessing, time
+
+WORDS = [
+    "reduce", "reduces", "reduced", "increase", "increases", "cause", "causes",
+    "causing", "prevent", "prevents", "treat", "treating", "improve", "improves",
+    "lower", "lowers", "protect", "protects", "shorten", "shortens", "affect",
+    "is", "was", "are", "does", "do", "lie", "lying", "better", "spread",
+]
+
+
+
+
+def rss() -> float:
+    """
+    Resident memory of the process in MB
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.
+
+
+def nltk_synonyms():
+    from nltk.corpus import wordnet
+    wordnet.ensure_loaded()
+    return lambda word: list({s.lemmas()[0].name() for s in wordnet.synsets(word)})
+
+
+def table_synonyms():
+    from models.wordnet import load, synonyms
+    load()
+    return synonyms
+
+
+def run(variant: str, repeat: int):
+    """
+    Load a variant and look the words up, in a fresh process
+    :return: startup seconds, RSS growth in MB, µs per lookup, synonyms
+    """
+    memory, start = rss(), time.perf_counter()
+    lookup = {"nltk": nltk_synonyms, "table": table_synonyms}[variant]()
+    startup, memory = time.perf_counter() - start, rss() - memory
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for word in WORDS: lookup(word)
+    latency = (time.perf_counter() - start) / repeat / len(WORDS) * 1e6
+    return startup, memory, latency, {word: set(lookup(word)) for word in WORDS}
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type = int, default = 100)
+    args = parser.parse_args()
+
+    # build the table ahead, so that its startup is a load
+    from models.wordnet import load
+    load()
+
+    context = multiprocessing.get_context("spawn")
+    results = dict()
+    for variant in ("nltk", "table"):
+        with context.Pool(1) as pool:
+            results[variant] = pool.apply(run, (variant, args.repeat))
+
+    reference = results["nltk"][3]
+    print(f"{'variant':>8} {'startup (s)':>12} {'RSS (MB)':>9} {'lookup (µs)':>12} {'agreement':>10}")
+    for variant, (startup, memory, latency, found) in results.items():
+        same = sum(found[word] == reference[word] for word in WORDS)
+        print(f"{variant:>8} {startup:>12.2f} {memory:>9.1f} {latency:>12.1f} {same:>6}/{len(WORDS)}")
+
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,509 @@
+import json, os, sqlite3, struct, time
+import numpy as np
+from collections import Counter, OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Iterable, Optional, Union
+from redis import Redis, RedisError
+
+# Binary embedding: magic, format version, dtype code, padding, dimension
+EMBEDDING_HEADER = struct.Struct('<3sBB3xI')
+EMBEDDING_MAGIC = b'SCE'
+EMBEDDING_VERSION = 1
+EMBEDDING_DTYPES = {1: np.dtype('<f4'), 2: np.dtype('<f2')}
+EMBEDDING_CODES = {dtype: code for code, dtype in EMBEDDING_DTYPES.items()}
+
+
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache with a time to live.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        """
+        :param maxsize: max number of entries
+        :param ttl: seconds before an entry expires, never if None
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] is not None and item[1] < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            size = len(self._data),
+            maxsize = self.maxsize,
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+            expirations = self.expirations,
+        )
+
+
+
+
+class RedisCache:
+    """
+    JSON values in Redis under a key prefix, with a time to live.
+    Redis errors are counted and behave as cache misses.
+    """
+    def __init__(
+        self,
+        client: Redis,
+        prefix: str,
+        ttl: Optional[float] = None,
+    ):
+        """
+        :param client: Redis client
+        :param prefix: namespace of the keys
+        :param ttl: seconds before an entry expires, never if None
+        """
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = self.misses = self.errors = 0
+
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            value = self.client.get(self._key(key))
+        except RedisError:
+            self.errors += 1
+            value = None
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(value)
+
+
+    def set(self, key: str, value: Any) -> None:
+        try:
+            self.client.set(
+                self._key(key), json.dumps(value),
+                ex = int(self.ttl) if self.ttl else None
+            )
+        except RedisError:
+            self.errors += 1
+
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            hits = self.hits,
+            misses = self.misses,
+            errors = self.errors,
+        )
+
+
+
+
+class SQLiteCache:
+    """
+    JSON values in a SQLite file, with a time to live.
+    Survives restarts and is shared by the processes of a host.
+    """
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        """
+        :param path: database file, created if missing
+        :param ttl: seconds before an entry expires, never if None
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+        self._pid = None
+        self._connection()
+        self.hits = self.misses = self.errors = 0
+
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Private. Connection of the current process, reopened after a fork
+        since a SQLite connection must not be shared across processes.
+        """
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread = False, isolation_level = None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)"
+            )
+            self._pid = os.getpid()
+        return self._db
+
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    "SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                    (key, time.time())
+                ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            row = None
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(row[0])
+
+
+    def set(self, key: str, value: Any) -> None:
+        try:
+            with self._lock:
+                self._connection().execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time() + self.ttl if self.ttl else None)
+                )
+        except sqlite3.Error:
+            self.errors += 1
+
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            hits = self.hits,
+            misses = self.misses,
+            errors = self.errors,
+        )
+
+
+
+
+class TieredCache:
+    """
+    Chain of caches, fastest first.
+    A hit in a slower tier is written back to the faster ones.
+    """
+    def __init__(self, *tiers):
+        """
+        :param tiers: caches with get, set and stats methods
+        """
+        self.tiers = [tier for tier in tiers if tier is not None]
+
+
+    def get(self, key: str, default: Any = None) -> Any:
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                return value
+        return default
+
+
+    def set(self, key: str, value: Any) -> None:
+        for tier in self.tiers:
+            tier.set(key, value)
+
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            type(tier).__name__: tier.stats()
+            for tier in self.tiers
+        }
+
+
+
+
+def encode_embedding(
+    embedding: Union[np.ndarray, list[float]],
+    dtype: str = 'float32',
+) -> bytes:
+    """
+    Serialize an embedding: header then raw little-endian values
+    :param embedding: vector
+    :param dtype: float32 or float16
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    vector = np.ascontiguousarray(embedding, dtype = dtype).ravel()
+    header = EMBEDDING_HEADER.pack(
+        EMBEDDING_MAGIC, EMBEDDING_VERSION,
+        EMBEDDING_CODES[dtype], vector.shape[0]
+    )
+    return header + vector.tobytes()
+
+
+
+
+def decode_embedding(value: bytes) -> np.ndarray:
+    """
+    Deserialize an embedding, see `encode_embedding`.
+    float32 vectors are read without copy, float16 ones are cast to float32.
+    Legacy JSON lists are accepted.
+    :param value: serialized embedding
+    :return: float32 vector, read-only for float32 values
+    """
+    if is_legacy_embedding(value):
+        return np.asarray(json.loads(value), dtype = np.float32)
+    magic, version, code, dim = EMBEDDING_HEADER.unpack_from(value)
+    if magic != EMBEDDING_MAGIC or version != EMBEDDING_VERSION:
+        raise ValueError(f"Unknown embedding format {magic!r} v{version}")
+    vector = np.frombuffer(
+        value, dtype = EMBEDDING_DTYPES[code],
+        count = dim, offset = EMBEDDING_HEADER.size
+    )
+    return vector if vector.dtype == np.float32 else vector.astype(np.float32)
+
+
+
+
+def is_legacy_embedding(value: bytes) -> bool:
+    """
+    Whether a value is an embedding stored as a JSON list
+    """
+    return value[:1] == b'['
+
+
+
+
+class EmbeddingCache:
+    """
+    Embeddings in Redis, namespaced by model, dimension and version:
+    `emb:<model>:<dim>:v<version>:<article id>`.
+    Keys expire after `ttl` seconds without being read, Redis evicts
+    the least frequently used ones beyond its `maxmemory`.
+    """
+    prefix = 'emb'
+
+    def __init__(
+        self,
+        client: Redis,
+        model: str,
+        dim: int,
+        version: str = '1',
+        dtype: str = 'float32',
+        ttl: Optional[int] = None,
+        legacy: bool = True,
+    ):
+        """
+        :param client: Redis client, without decoded responses
+        :param model: embedding model id
+        :param dim: embedding dimension, other vectors are ignored
+        :param version: bump to invalidate the embeddings of a model
+        :param dtype: float32 or float16
+        :param ttl: seconds before an unread embedding expires, never if None
+        :param legacy: look misses up under the bare article id,
+            see `migrate_embeddings` to move them all at once
+        """
+        self.client = client
+        self.model = model
+        self.dim = dim
+        self.dtype = dtype
+        self.ttl = ttl or None
+        self.use_legacy = legacy
+        self.namespace = f"{self.prefix}:{model}:{dim}:v{version}"
+        self.hits = self.misses = self.legacy = 0
+        self._lock = Lock()
+
+
+    def key(self, id: str) -> str:
+        return f"{self.namespace}:{id}"
+
+
+    def get_many(self, ids: list[str]) -> dict[str, Optional[np.ndarray]]:
+        """
+        Get embeddings, refreshing their time to live.
+        Embeddings stored by an earlier version under the bare article id
+        are moved to the namespace when their dimension matches.
+        :param ids: article ids
+        :return: embeddings by id, None when missing
+        """
+        pipe = self.client.pipeline(transaction = False)
+        for id in ids:
+            if self.ttl: pipe.getex(self.key(id), ex = self.ttl)
+            else: pipe.get(self.key(id))
+        cached = dict(zip(ids, map(self._decode, pipe.execute())))
+
+        missing = [id for id, vector in cached.items() if vector is None]
+        if missing and self.use_legacy:
+            legacy = dict(zip(missing, map(self._decode, self.client.mget(missing))))
+            legacy = {id: vector for id, vector in legacy.items() if vector is not None}
+            if legacy:
+                self.set_many(legacy)
+                self.client.delete(*legacy)
+                cached.update(legacy)
+
+        hits = sum(vector is not None for vector in cached.values())
+        with self._lock:
+            self.hits += hits
+            self.misses += len(cached) - hits
+            self.legacy += len(missing) - (len(cached) - hits)
+        return cached
+
+
+    def set_many(self, embeddings: dict[str, Union[np.ndarray, list[float]]]) -> None:
+        """
+        Write embeddings in a single round trip
+        :param embeddings: embeddings by article id
+        """
+        pipe = self.client.pipeline(transaction = False)
+        for id, vector in embeddings.items():
+            pipe.set(self.key(id), encode_embedding(vector, self.dtype), ex = self.ttl)
+        pipe.execute()
+
+
+    def exists_many(self, ids: list[str]) -> list[bool]:
+        """
+        Whether embeddings are cached, without reading them
+        :param ids: article ids
+        """
+        pipe = self.client.pipeline(transaction = False)
+        for id in ids: pipe.exists(self.key(id))
+        return [bool(found) for found in pipe.execute()]
+
+
+    def _decode(self, value: Optional[bytes]) -> Optional[np.ndarray]:
+        """
+        Private. Decode a value, None if missing, invalid or of another dimension
+        """
+        if not value: return None
+        try:
+            vector = decode_embedding(value)
+        except (ValueError, struct.error, KeyError):
+            return None
+        return vector if vector.shape == (self.dim,) else None
+
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return dict(
+                namespace = self.namespace,
+                hits = self.hits,
+                misses = self.misses,
+                legacy_moved = self.legacy,
+                hit_ratio = self.hits / requests if requests else None,
+            )
+
+
+    def report(self, scan_count: int = 1000) -> dict[str, Any]:
+        """
+        Memory of the Redis service and number of embeddings per namespace.
+        Scans every embedding key, meant for administration only.
+        :param scan_count: keys per SCAN round trip
+        """
+        memory = self.client.info('memory')
+        server = self.client.info('stats')
+        # article ids may contain ':', the namespace has a fixed number of parts
+        namespaces = Counter(
+            b':'.join(key.split(b':', 4)[:4]).decode()
+            for key in self.client.scan_iter(match = f"{self.prefix}:*", count = scan_count)
+        )
+        lookups = server.get('keyspace_hits', 0) + server.get('keyspace_misses', 0)
+        return dict(
+            cache = self.stats(),
+            redis = dict(
+                used_memory = memory.get('used_memory'),
+                maxmemory = memory.get('maxmemory'),
+                maxmemory_policy = memory.get('maxmemory_policy'),
+                evicted_keys = server.get('evicted_keys'),
+                expired_keys = server.get('expired_keys'),
+                hit_ratio = server.get('keyspace_hits', 0) / lookups if lookups else None,
+            ),
+            namespaces = dict(namespaces),
+        )
+
+
+
+
+def migrate_embeddings(
+    cache: EmbeddingCache,
+    keys: Optional[Iterable[bytes]] = None,
+    batch_size: int = 500,
+) -> int:
+    """
+    Move embeddings stored under bare article ids, as JSON or binary,
+    to the namespace of a cache. Values of another dimension, or not
+    embeddings such as the other caches of the API, are left. Keys of
+    the namespaced embeddings are skipped: article ids may contain ':'.
+    :param cache: EmbeddingCache of the model that wrote the embeddings
+    :param keys: keys to migrate, every key of the database if None
+    :param batch_size: keys read and written per round trip
+    :return: number of migrated keys
+    """
+    client = cache.client
+    keys = iter(client.scan_iter(count = batch_size) if keys is None else keys)
+    prefix = f"{cache.prefix}:".encode()
+    migrated = 0
+    while True:
+        batch = [key for _, key in zip(range(batch_size), keys)]
+        if not batch: return migrated
+        batch = [key for key in batch if not key.startswith(prefix)]
+        if not batch: continue
+        legacy = {
+            key.decode(): vector
+            for key, vector in zip(batch, map(cache._decode, client.mget(batch)))
+            if vector is not None
+        }
+        if not legacy: continue
+        cache.set_many(legacy)
+        client.delete(*legacy)
+        migrated += len(legacy)
+
+
+
+
+if __name__ == "__main__":
+    import argparse
+    from .utils import redis_connection, DENSE_MODEL
+
+    parser = argparse.ArgumentParser(description = "Move embeddings of an earlier version to the model namespace")
+    parser.add_argument("--model", default = DENSE_MODEL)
+    parser.add_argument("--dim", type = int, default = 768)
+    parser.add_argument("--version", default = os.getenv('EMBEDDING_CACHE_VERSION', '1'))
+    parser.add_argument("--dtype", default = os.getenv('EMBEDDING_DTYPE', 'float32'), choices = ["float32", "float16"])
+    args = parser.parse_args()
+    cache = EmbeddingCache(
+        redis_connection(decode_responses = False),
+        model = args.model, dim = args.dim,
+        version = args.version, dtype = args.dtype,
+    )
+    print(migrate_embeddings(cache), "embeddings migrated to", cache.namespace)
@@ -1,53 +1,274 @@
 from haystack.nodes import (
+    BaseRanker,
     MultihopEmbeddingRetriever,
-    BM25Retriever
+    BM25Retriever,
+    SentenceTransformersRanker,
+    FARMReader,
 )
+from haystack.nodes.retriever._base_embedding_encoder import _BaseEmbeddingEncoder
+from haystack.nodes.retriever._embedding_encoder import _EMBEDDING_ENCODERS
 from haystack.schema import Document
+from spacy import util
 from spacy.lang.en import English
+from spacy.language import Language
+from spacy.tokens import Doc, Span
 from scispacy.abbreviation import AbbreviationDetector
 from spacyfishing import EntityFishing
 from typing import Optional, Any
+import numpy as np
+import requests, torch
+from transformers import AutoTokenizer
+from .cache import LRUCache, SQLiteCache, TieredCache
+from .onnx import OnnxEncoder, OnnxClassifier, reader_path
 
 
 
 
-class DynamicRetriever:
-    def run(
+class _OnnxEmbeddingEncoder(_BaseEmbeddingEncoder):
+    """
+    Private. Embedding encoder of the retrievers running the int8 ONNX
+    export of their model, registered as the `onnx` model format
+    """
+    def __init__(self, retriever):
+        self.encoder = OnnxEncoder(retriever.embedding_model)
+        self.batch_size = retriever.batch_size
+
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        return self.encoder(queries, self.batch_size)
+
+    def embed_documents(self, docs: list[Document]) -> np.ndarray:
+        return self.encoder([doc.content for doc in docs], self.batch_size)
+
+
+_EMBEDDING_ENCODERS['onnx'] = _OnnxEmbeddingEncoder
+
+
+
+
+class OnnxMultihopEmbeddingRetriever(MultihopEmbeddingRetriever):
+    """
+    Dense retriever encoding with the int8 ONNX export of its model,
+    the PyTorch model is never loaded
+    """
+    def __init__(self, embedding_model: str, **kwargs):
+        super().__init__(embedding_model = embedding_model, **{**kwargs, 'model_format': 'onnx'})
+
+
+
+
+class OnnxSentenceTransformersRanker(SentenceTransformersRanker):
+    """
+    Ranker scoring with the int8 ONNX export of its model,
+    the PyTorch model is never loaded
+    """
+    def __init__(
         self,
-        root_node: str,
-        query: Optional[str] = None,
-        filters: Optional[Any] = None,
-        top_k: Optional[int] = None,
-        documents: Optional[list[Document]] = None,
-        index: Optional[str] = None,
-        headers: Optional[dict[str, str]] = None,
-        scale_score: Optional[bool] = None,
-        document_store = None,
+        model_name_or_path: str,
+        top_k: int = 10,
+        batch_size: int = 16,
+        scale_score: bool = True,
+        progress_bar: bool = True,
+        embed_meta_fields: Optional[list[str]] = None,
+        **kwargs,
     ):
-        old_document_store = self.document_store
-        if document_store is not None:
-            self.document_store = document_store
-        result = super().run(
-            root_node, query,
-            filters, top_k,
-            documents, index,
-            headers, scale_score,
+        """
+        Set the attributes of SentenceTransformersRanker without calling
+        its constructor, which loads the PyTorch model. The export runs on
+        CPU: device and model loading parameters are ignored.
+        """
+        BaseRanker.__init__(self)
+        self.top_k = top_k
+        self.devices = [torch.device('cpu')]
+        self.progress_bar = progress_bar
+        self.batch_size = batch_size
+        self.embed_meta_fields = embed_meta_fields
+        self.transformer_model = OnnxClassifier(model_name_or_path)
+        self.transformer_tokenizer = AutoTokenizer.from_pretrained(self.transformer_model.path)
+        self.activation_function = (
+            torch.nn.Sigmoid() if self.transformer_model.config.num_labels == 1 and scale_score
+            else torch.nn.Identity()
         )
-        if old_document_store is not None:
-            self.document_store = old_document_store
-        return result
 
 
 
 
-class DyBM25Retriever(DynamicRetriever, BM25Retriever):
-    pass
+class OnnxFARMReader(FARMReader):
+    """
+    Reader running the int8 ONNX export of its model
+    """
+    def __init__(self, model_name_or_path: str, **kwargs):
+        super().__init__(model_name_or_path = str(reader_path(model_name_or_path)), **kwargs)
+
+
+
+
+@Language.factory("cached_entityfishing", default_config={
+    "api_ef_base": "https://cloud.science-miner.com/nerd/service",
+    "language": "en",
+    "extra_info": False,
+    "filter_statements": [],
+    "verbose": False,
+    "cache_size": 4096,
+    "cache_path": ".cache/entityfishing.sqlite",
+    "cache_ttl": 30 * 24 * 3600,
+    "timeout": 2.,
+})
+class CachedEntityFishing(EntityFishing):
+    """
+    EntityFishing with a cache of the linked mentions.
+    Mentions are looked up in memory, then in a SQLite file, and only the
+    missing ones are sent to entity-fishing: the mentions of a batch of
+    docs go in a single request, whose text joins the docs. A mention is
+    linked once whatever its question, unlinked mentions are cached too.
+    """
+    def __init__(
+        self,
+        nlp: Language,
+        name: str,
+        api_ef_base: str,
+        language: str,
+        extra_info: bool,
+        filter_statements: list,
+        verbose: bool,
+        cache_size: int,
+        cache_path: str,
+        cache_ttl: float,
+        timeout: float,
+    ):
+        """
+        :param cache_size: mentions kept in memory
+        :param cache_path: SQLite file of the mentions, empty for none
+        :param cache_ttl: seconds before a cached mention is linked again
+        :param timeout: seconds allowed for an entity-fishing request
+        """
+        super().__init__(nlp, name, api_ef_base, language, extra_info, filter_statements, verbose)
+        self.cache = TieredCache(
+            LRUCache(maxsize = cache_size, ttl = cache_ttl),
+            SQLiteCache(cache_path, ttl = cache_ttl) if cache_path else None,
+        )
+        self.timeout = timeout
+        self.requests = self.refused = 0
+
+
+    def _key(self, span: Span) -> str:
+        return f"{self.language['lang']}:{' '.join(span.text.split())}"
+
+
+    def _attach(self, doc: Doc, span: Span, entity: dict) -> None:
+        """
+        Private. Set the extensions of a span from an entity-fishing entity
+        """
+        self.updated_entities(doc, [{**entity, 'offsetStart': span.start_char, 'offsetEnd': span.end_char}])
+
+
+    def disambiguate_text_batch(self, files_batch: list[dict]) -> list[requests.Response]:
+        """
+        Disambiguation requests, as EntityFishing but with a timeout: a
+        request failing or not answering in time has no response, and an
+        entity-fishing hanging does not keep the linker threads busy
+        """
+        responses = list()
+        for files in files_batch:
+            try:
+                responses.append(requests.post(
+                    self.api_ef_base + "disambiguate",
+                    headers = {"Accept": "application/json"},
+                    files = files,
+                    timeout = self.timeout
+                ))
+            except requests.RequestException:
+                pass
+        return responses
+
+
+    def _request(self, text: str, terms: str, spans: list[Span]) -> list[dict]:
+        """
+        Private. One disambiguation call. A request refused by entity-fishing,
+        such as a text too short, links no entity, as in EntityFishing.
+        :raises ConnectionError: entity-fishing did not answer, or failed
+        """
+        self.requests += 1
+        results = self.main_disambiguation_process_batch([text], [terms], [spans])
+        if not results:
+            raise ConnectionError("entity-fishing did not answer")
+        _, metadata, entities = results[0]
+        if metadata['status_code'] >= 500:
+            raise ConnectionError(f"entity-fishing failed ({metadata['status_code']})")
+        if not metadata['ok']:
+            self.refused += 1
+            return []
+        return entities
+
+
+    def _disambiguate(self, docs: list[Doc], missing: list[tuple[int, Span]]) -> list[Optional[dict]]:
+        """
+        Private. Link the missing mentions of docs in a single request on the
+        joined docs, then the mentions left unlinked on their terms alone,
+        as EntityFishing does
+        :return: entity of each missing mention, None if unlinked
+        """
+        joined = Doc.from_docs(docs) if len(docs) > 1 else docs[0]
+        starts, token = list(), 0
+        for doc in docs:
+            starts.append(joined[token].idx if len(doc) else 0)
+            token += len(doc)
+        spans = [
+            joined.char_span(starts[i] + ent.start_char, starts[i] + ent.end_char)
+            for i, ent in missing
+        ]
+        linked = {
+            (entity['offsetStart'], entity['offsetEnd']): entity
+            for entity in self._request(joined.text, "", [span for span in spans if span is not None])
+            if 'offsetStart' in entity
+        }
+        found = [
+            linked.get((span.start_char, span.end_char)) if span is not None else None
+            for span in spans
+        ]
+
+        unlinked = [span for span, entity in zip(spans, found) if span is not None and entity is None]
+        if unlinked:
+            terms = " ".join(span.text for span in spans if span is not None)
+            named = {entity['rawName']: entity for entity in self._request("", terms, unlinked)}
+            found = [
+                entity or (named.get(span.text) if span is not None else None)
+                for span, entity in zip(spans, found)
+            ]
+        return found
+
 
+    def _link_batch(self, docs: list[Doc]) -> None:
+        """
+        Private. Link the mentions of docs, from the cache when possible
+        """
+        missing = list()
+        for i, doc in enumerate(docs):
+            for ent in doc.ents:
+                entity = self.cache.get(self._key(ent))
+                if entity is None:
+                    missing.append((i, ent))
+                elif entity:
+                    self._attach(doc, ent, entity)
+        if not missing:
+            return
+        for (i, ent), entity in zip(missing, self._disambiguate(docs, missing)):
+            if entity is not None:
+                entity = {k: v for k, v in entity.items() if k not in ('offsetStart', 'offsetEnd')}
+                self._attach(docs[i], ent, entity)
+            # unlinked mentions are cached as empty entities
+            self.cache.set(self._key(ent), entity or {})
 
 
+    def __call__(self, doc: Doc) -> Doc:
+        self._link_batch([doc])
+        return doc
 
-class DyMultihopEmbeddingRetriever(DynamicRetriever, MultihopEmbeddingRetriever):
-    pass
 
+    def pipe(self, stream, batch_size: int = 128):
+        for docs in util.minibatch(stream, size = batch_size):
+            self._link_batch(docs)
+            yield from docs
 
 
+    def stats(self) -> dict[str, Any]:
+        return dict(requests = self.requests, refused = self.refused, cache = self.cache.stats())
@@ -0,0 +1,221 @@
+"""
+Export of the EQA models to ONNX with dynamic int8 quantization,
+and their ONNX Runtime sessions for the `onnx` backend.
+
+    python -m models.onnx
+
+Exports are written once under ONNX_DIR, the backend exports a missing
+model when it loads it.
+"""
+import json, os
+from pathlib import Path
+from types import SimpleNamespace
+import numpy as np, torch
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+from .workers import WORKERS
+
+ONNX_DIR = os.getenv('ONNX_DIR', '.cache/onnx')
+ONNX_THREADS = int(os.getenv('ONNX_THREADS', '0'))
+
+
+
+
+def model_dir(model: str, kind: str) -> Path:
+    """
+    Directory of the ONNX export of a model
+    :param model: Hugging Face model id
+    :param kind: dense, ranker or reader
+    """
+    return Path(ONNX_DIR) / model.replace('/', '--') / kind
+
+
+def session(path: Path, threads: int = ONNX_THREADS):
+    """
+    ONNX Runtime session of an exported model
+    :param path: onnx file
+    :param threads: intra-op threads, 0 to share the CPUs between the inference workers
+    """
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads or max(1, (os.cpu_count() or 1) // WORKERS)
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(str(path), options, providers = ['CPUExecutionProvider'])
+
+
+
+
+class _Named(torch.nn.Module):
+    """
+    Private. Call a transformers model with positional tokenizer inputs
+    """
+    def __init__(self, model: torch.nn.Module, names: list[str]):
+        super().__init__()
+        self.model = model
+        self.names = names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.names, inputs)))[0]
+
+
+def export(model: torch.nn.Module, tokenizer, path: Path, output: str) -> Path:
+    """
+    Export a transformers model to ONNX and quantize its weights to int8
+    :param model: model called with the tokenizer inputs
+    :param tokenizer: tokenizer of the model
+    :param path: directory of the export
+    :param output: name of the first output of the model
+    :return: path of the quantized model
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    path.mkdir(parents = True, exist_ok = True)
+    names = list(tokenizer.model_input_names)
+    sample = tokenizer(["an example sentence"], ["and its pair"], return_tensors = 'pt')
+    axes = {name: {0: 'batch', 1: 'sequence'} for name in names}
+    torch.onnx.export(
+        _Named(model.eval(), names),
+        tuple(sample[name] for name in names),
+        str(path / 'model.onnx'),
+        input_names = names,
+        output_names = [output],
+        dynamic_axes = {**axes, output: {0: 'batch'}},
+        opset_version = 14,
+    )
+    quantize_dynamic(path / 'model.onnx', path / 'model.int8.onnx', weight_type = QuantType.QInt8)
+    (path / 'model.onnx').unlink()
+    tokenizer.save_pretrained(path)
+    return path / 'model.int8.onnx'
+
+
+
+
+def dense_path(model: str) -> Path:
+    """
+    Export a sentence-transformers model, without its pooling
+    :param model: model id
+    :return: directory of the export
+    """
+    path = model_dir(model, 'dense')
+    if (path / 'model.int8.onnx').exists(): return path
+    from sentence_transformers import SentenceTransformer
+    encoder = SentenceTransformer(model, device = 'cpu')
+    pooling = encoder[1].get_config_dict()
+    export(encoder[0].auto_model, encoder.tokenizer, path, 'last_hidden_state')
+    with open(path / 'pooling.json', 'w') as f:
+        json.dump(dict(
+            mode = 'cls' if pooling['pooling_mode_cls_token'] else 'mean',
+            max_seq_length = encoder.max_seq_length,
+            normalize = any(type(module).__name__ == 'Normalize' for module in encoder),
+        ), f)
+    return path
+
+
+def ranker_path(model: str) -> Path:
+    """
+    Export a sequence classification model
+    :param model: model id
+    :return: directory of the export
+    """
+    path = model_dir(model, 'ranker')
+    if (path / 'model.int8.onnx').exists(): return path
+    export(
+        AutoModelForSequenceClassification.from_pretrained(model),
+        AutoTokenizer.from_pretrained(model),
+        path, 'logits'
+    )
+    AutoConfig.from_pretrained(model).save_pretrained(path)
+    return path
+
+
+def reader_path(model: str) -> Path:
+    """
+    Export a question answering model with the converter of FARMReader
+    :param model: model id
+    :return: directory of the export, loadable by FARMReader
+    """
+    path = model_dir(model, 'reader')
+    if (path / 'quantization.json').exists(): return path
+    from haystack.nodes import FARMReader
+    FARMReader.convert_to_onnx(
+        model_name = model,
+        output_path = path,
+        quantize = True,
+        task_type = 'question_answering',
+    )
+    # the int8 graph is written aside, FARMReader only loads model.onnx
+    os.replace(path / 'model-quantized.onnx', path / 'model.onnx')
+    with open(path / 'quantization.json', 'w') as f:
+        json.dump(dict(weight_type = 'QInt8'), f)
+    return path
+
+
+
+
+class OnnxEncoder:
+    """
+    Sentence embeddings of an exported sentence-transformers model
+    """
+    def __init__(self, model: str):
+        path = dense_path(model)
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.session = session(path / 'model.int8.onnx')
+        self.names = [node.name for node in self.session.get_inputs()]
+        with open(path / 'pooling.json') as f:
+            self.pooling = json.load(f)
+
+
+    def __call__(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        """
+        :param texts: sentences to encode
+        :param batch_size: sentences per session run
+        :return: embeddings, one row per sentence
+        """
+        embeddings = list()
+        for i in range(0, len(texts), batch_size):
+            features = self.tokenizer(
+                texts[i:i + batch_size],
+                padding = True, truncation = True,
+                max_length = self.pooling['max_seq_length'],
+                return_tensors = 'np'
+            )
+            hidden = self.session.run(None, {name: features[name] for name in self.names})[0]
+            if self.pooling['mode'] == 'cls':
+                pooled = hidden[:, 0]
+            else:
+                mask = features['attention_mask'][..., None]
+                pooled = (hidden * mask).sum(1) / np.clip(mask.sum(1), 1e-9, None)
+            if self.pooling['normalize']:
+                pooled = pooled / np.linalg.norm(pooled, axis = 1, keepdims = True)
+            embeddings.append(pooled.astype(np.float32))
+        return np.concatenate(embeddings) if embeddings else np.zeros((0, 0), np.float32)
+
+
+
+
+class OnnxClassifier:
+    """
+    Exported sequence classification model, called like its transformers model
+    """
+    def __init__(self, model: str):
+        self.path = path = ranker_path(model)
+        self.config = AutoConfig.from_pretrained(path)
+        self.session = session(path / 'model.int8.onnx')
+        self.names = [node.name for node in self.session.get_inputs()]
+
+
+    def __call__(self, **features: torch.Tensor) -> SimpleNamespace:
+        logits = self.session.run(None, {name: features[name].cpu().numpy() for name in self.names})[0]
+        return SimpleNamespace(logits = torch.from_numpy(logits))
+
+
+
+
+if __name__ == "__main__":
+    import argparse
+    from .utils import DENSE_MODEL, RANKER_MODEL, READER_MODEL
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dense", default = DENSE_MODEL)
+    parser.add_argument("--ranker", default = RANKER_MODEL)
+    parser.add_argument("--reader", default = READER_MODEL)
+    args = parser.parse_args()
+    for build, model in ((dense_path, args.dense), (ranker_path, args.ranker), (reader_path, args.reader)):
+        print(f"{model}: {build(model)}")
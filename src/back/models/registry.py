@@ -0,0 +1,126 @@
+import logging, os, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+LOADERS = int(os.getenv('MODEL_LOADERS', '3'))
+WARM_UP = os.getenv('MODEL_WARM_UP', '1') == '1'
+
+
+
+
+class ModelRegistry:
+    """
+    Load models in background threads and report their state.
+    A model goes from pending to loading, warming, then ready, or failed.
+    It is published once warm, so that the first request using it does
+    not pay for the lazy allocations of its first inference.
+    """
+    def __init__(
+        self,
+        loaders: int = LOADERS,
+        warm_up: bool = WARM_UP,
+    ):
+        """
+        :param loaders: models loaded in parallel
+        :param warm_up: run the warm-up of the models
+        """
+        self.warm_up = warm_up
+        self.executor = ThreadPoolExecutor(
+            max_workers = loaders,
+            thread_name_prefix = 'loader'
+        )
+        self.models = dict()
+        self.states = dict()
+        self._lock = Lock()
+
+
+    def load(
+        self,
+        name: str,
+        factory: Callable[[], Any],
+        warm_up: Optional[Callable[[Any], Any]] = None,
+        on_ready: Optional[Callable[[Any], Any]] = None,
+    ) -> Future:
+        """
+        Load a model in the background
+        :param name: model name
+        :param factory: returns the model
+        :param warm_up: runs a dummy inference on the model
+        :param on_ready: called with the model before it is ready
+        """
+        with self._lock:
+            self.states[name] = dict(
+                state = 'pending', load_time = None,
+                warm_up_time = None, error = None
+            )
+        return self.executor.submit(self._load, name, factory, warm_up, on_ready)
+
+
+    def _update(self, name: str, **state):
+        with self._lock:
+            self.states[name].update(state)
+
+
+    def _load(
+        self,
+        name: str,
+        factory: Callable[[], Any],
+        warm_up: Optional[Callable[[Any], Any]],
+        on_ready: Optional[Callable[[Any], Any]],
+    ):
+        """
+        Private. Load, warm up and publish a model
+        """
+        self._update(name, state = 'loading')
+        start = time.monotonic()
+        try:
+            model = factory()
+        except Exception as e:
+            logger.exception("Loading %s failed", name)
+            self._update(name, state = 'failed', error = repr(e))
+            return
+        self._update(name, state = 'warming', load_time = round(time.monotonic() - start, 3))
+
+        if warm_up is not None and self.warm_up:
+            start = time.monotonic()
+            try:
+                warm_up(model)
+            except Exception as e:
+                # the model still works, only its first request is slower
+                logger.warning("Warming up %s failed: %r", name, e)
+            self._update(name, warm_up_time = round(time.monotonic() - start, 3))
+
+        try:
+            if on_ready is not None: on_ready(model)
+        except Exception as e:
+            logger.exception("Publishing %s failed", name)
+            self._update(name, state = 'failed', error = repr(e))
+            return
+        with self._lock:
+            self.models[name] = model
+            self.states[name]['state'] = 'ready'
+        logger.info("%s ready in %.1fs", name, self.states[name]['load_time'])
+
+
+    def ready(self, *names: str) -> bool:
+        """
+        Whether models are ready, all of them if no name is given
+        """
+        with self._lock:
+            names = names or tuple(self.states)
+            return all(name in self.models for name in names)
+
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return dict(
+                ready = len(self.models) == len(self.states),
+                models = {name: dict(state) for name, state in self.states.items()},
+            )
+
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
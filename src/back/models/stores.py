@@ -0,0 +1,195 @@
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Callable, Optional
+from haystack.document_stores.memory import InMemoryDocumentStore
+from haystack.schema import Document
+
+MAX_DOCUMENTS = int(os.getenv('DOCSTORE_MAX_DOCUMENTS', '5000'))
+
+
+
+
+@dataclass
+class StoreEntry:
+    store: InMemoryDocumentStore
+    ids: frozenset
+    refs: int = 0
+
+
+
+
+class DocumentStorePool:
+    """
+    Document stores shared between websocket sessions.
+    Stores are keyed by the set of article ids and reference counted:
+    sessions selecting the same articles share one store. A store only used
+    by the session changing its selection is updated in place, adding and
+    removing documents instead of being rebuilt; a store shared with other
+    sessions is copied with its embedded documents still selected, only the
+    new ones are embedded. Unused stores are kept for reuse and evicted least
+    recently used first when they hold more than `max_documents` documents.
+    """
+    def __init__(
+        self,
+        create: Callable[[list[dict[str, str]]], InMemoryDocumentStore],
+        embed: Callable[[list[dict[str, str]]], list[Document]],
+        max_documents: int = MAX_DOCUMENTS,
+    ):
+        """
+        :param create: build a store from articles, see `EQA.create_document_store`
+        :param embed: embed articles, see `EQA.embed_documents`
+        :param max_documents: documents kept in unused stores, stores in use
+            are never evicted
+        """
+        self.create = create
+        self.embed = embed
+        self.max_documents = max_documents
+        self.entries: OrderedDict[frozenset, StoreEntry] = OrderedDict()
+        self._lock = Lock()
+        self.hits = self.builds = self.updates = self.extends = self.evictions = 0
+
+
+    def acquire(
+        self,
+        articles: list[dict[str, str]],
+        previous: Optional[frozenset] = None,
+    ) -> tuple[frozenset, InMemoryDocumentStore]:
+        """
+        Get the store of a selection, releasing the previous one
+        :param articles: list of articles with id and content
+        :param previous: key of the previous selection of the session
+        :return: key and store of the selection
+        """
+        key = frozenset(article['id'] for article in articles)
+        entry, kept = None, list()
+        with self._lock:
+            owned = self.entries.get(previous)
+            if owned is not None and owned.refs == 1 and key not in self.entries:
+                # only used by this session: take it out and update it
+                entry = self.entries.pop(previous)
+            else:
+                self._release(previous)
+                if key in self.entries:
+                    self.hits += 1
+                    return key, self._use(key)
+                if owned is not None:
+                    # shared: copy the documents still selected, under the
+                    # lock since another session may update the store
+                    kept = owned.store.get_documents_by_id(list(owned.ids & key))
+
+        try:
+            if entry is not None:
+                store = self._update(entry.store, entry.ids, key, articles)
+            elif kept:
+                store = self._extend(kept, articles)
+            else:
+                store = self.create(articles)
+        except Exception:
+            # the session keeps its previous selection
+            with self._lock:
+                if entry is not None:
+                    restored = self.entries.setdefault(previous, entry)
+                    # rebuilt by another session meanwhile: share its entry
+                    if restored is not entry: restored.refs += entry.refs
+                elif previous in self.entries:
+                    self._use(previous)
+            raise
+
+        with self._lock:
+            if entry is not None: self.updates += 1
+            elif kept: self.extends += 1
+            else: self.builds += 1
+            if key not in self.entries:
+                self.entries[key] = StoreEntry(store, key)
+            store = self._use(key)
+            self._evict()
+        return key, store
+
+
+    def release(self, key: Optional[frozenset]) -> None:
+        """
+        Release the store of a selection, it stays available for reuse
+        :param key: key returned by `acquire`
+        """
+        with self._lock:
+            self._release(key)
+            self._evict()
+
+
+    def _update(
+        self,
+        store: InMemoryDocumentStore,
+        ids: frozenset,
+        key: frozenset,
+        articles: list[dict[str, str]],
+    ) -> InMemoryDocumentStore:
+        """
+        Private. Remove the documents no longer selected and add the new ones.
+        The new ones are embedded first: the store is unchanged if it fails
+        """
+        removed = list(ids - key)
+        added = [article for article in articles if article['id'] not in ids]
+        documents = self.embed(added) if added else []
+        if removed: store.delete_documents(ids = removed)
+        if documents: store.write_documents(documents)
+        return store
+
+
+    def _extend(
+        self,
+        kept: list[Document],
+        articles: list[dict[str, str]],
+    ) -> InMemoryDocumentStore:
+        """
+        Private. Build a store from embedded documents and the articles
+        missing from them
+        """
+        ids = {doc.id for doc in kept}
+        store = self.create([article for article in articles if article['id'] not in ids])
+        store.write_documents(kept)
+        return store
+
+
+    def _use(self, key: frozenset) -> InMemoryDocumentStore:
+        entry = self.entries[key]
+        entry.refs += 1
+        self.entries.move_to_end(key)
+        return entry.store
+
+
+    def _release(self, key: Optional[frozenset]) -> None:
+        entry = self.entries.get(key)
+        if entry is not None and entry.refs > 0:
+            entry.refs -= 1
+
+
+    def _evict(self) -> None:
+        """
+        Private. Drop unused stores, least recently used first
+        """
+        size = sum(len(entry.ids) for entry in self.entries.values() if entry.refs == 0)
+        for key in list(self.entries):
+            if size <= self.max_documents: return
+            entry = self.entries[key]
+            if entry.refs > 0: continue
+            del self.entries[key]
+            size -= len(entry.ids)
+            self.evictions += 1
+
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return dict(
+                stores = len(self.entries),
+                in_use = sum(entry.refs > 0 for entry in self.entries.values()),
+                sessions = sum(entry.refs for entry in self.entries.values()),
+                documents = sum(len(entry.ids) for entry in self.entries.values()),
+                max_documents = self.max_documents,
+                hits = self.hits,
+                builds = self.builds,
+                updates = self.updates,
+                extends = self.extends,
+                evictions = self.evictions,
+            )
@@ -1,8 +1,10 @@
-import pandas as pd, redis, json
-from typing import Any, Union
-from haystack.pipelines import Pipeline
+import numpy as np, redis, json, os, logging
+from collections import Counter
+from threading import Lock
+from typing import Any, Callable, Optional, Union
 from haystack.document_stores.memory import InMemoryDocumentStore
 from haystack.nodes import (
+    BM25Retriever, MultihopEmbeddingRetriever,
     SentenceTransformersRanker, FARMReader,
     JoinDocuments,
 )
@@ -10,132 +12,396 @@ from haystack.schema import Document
 from scispacy.abbreviation import AbbreviationDetector
 from spacy import load as spacy_load, Language
 from spacyfishing import EntityFishing
+from .cache import EmbeddingCache
+from .workers import MicroBatcher
 from .components import (
-    DyBM25Retriever,
-    DyMultihopEmbeddingRetriever
+    CachedEntityFishing,
+    OnnxMultihopEmbeddingRetriever,
+    OnnxSentenceTransformersRanker,
+    OnnxFARMReader,
 )
 
+DENSE_MODEL = "sentence-transformers/multi-qa-mpnet-base-dot-v1"
+RANKER_MODEL = "sebastian-hofstaetter/distilbert-dot-tas_b-b256-msmarco"
+READER_MODEL = "deepset/roberta-base-squad2"
 
+BACKEND = os.getenv('EQA_BACKEND', 'torch')
 
+# Query parsing only needs the tags and the entities of the question:
+# model, excluded components and added components of each profile
+TOKEN_PROFILES = {
+    'full': ("en_core_sci_scibert", [], ["abbreviation_detector"]),
+    'lean': ("en_core_sci_scibert", ["parser", "lemmatizer"], []),
+    'small': ("en_core_sci_sm", ["parser", "lemmatizer"], []),
+}
+TOKEN_PROFILE = os.getenv('TOKEN_PROFILE', 'lean')
 
-def token_pipeline() -> Language:
+EF_CACHE_SIZE = int(os.getenv('EF_CACHE_SIZE', '4096'))
+EF_CACHE_PATH = os.getenv('EF_CACHE_PATH', '.cache/entityfishing.sqlite')
+EF_CACHE_TTL = float(os.getenv('EF_CACHE_TTL', str(30 * 24 * 3600)))
+EF_TIMEOUT = float(os.getenv('EF_TIMEOUT', '2'))
+
+EMBEDDING_DTYPE = os.getenv('EMBEDDING_DTYPE', 'float32')
+EMBEDDING_VERSION = os.getenv('EMBEDDING_CACHE_VERSION', '1')
+EMBEDDING_TTL = int(os.getenv('EMBEDDING_CACHE_TTL', str(30 * 24 * 3600)))
+EMBEDDING_LEGACY = os.getenv('EMBEDDING_CACHE_LEGACY', '1') == '1'
+
+# dummy inputs of the warm-up inferences
+WARM_UP_QUESTION = "Does aspirin reduce the risk of colorectal cancer?"
+WARM_UP_ABSTRACT = (
+    "Regular aspirin use was associated with a lower risk of colorectal cancer "
+    "in a cohort of adults followed for ten years."
+)
+
+logger = logging.getLogger(__name__)
+
+# receives the type and data of the partial results of a question
+EventCallback = Optional[Callable[[str, Any], None]]
+
+
+
+
+def token_pipeline(profile: str = TOKEN_PROFILE, linker: bool = True) -> Language:
     """
-    Return SciBERT SpaCy model with entityfishing
+    Return SciSpaCy model with entityfishing
+    :param profile: full, lean or small, see `TOKEN_PROFILES`
+    :param linker: add entityfishing
     """
-    model = spacy_load("en_core_sci_scibert")
-    model.add_pipe("abbreviation_detector")
+    name, exclude, extra = TOKEN_PROFILES[profile]
+    model = spacy_load(name, exclude = exclude)
+    for pipe in extra:
+        model.add_pipe(pipe)
+    if not linker:
+        return model
     model.add_pipe(
-        "entityfishing",
+        "cached_entityfishing",
+        name = "entityfishing",
         config = {
             "extra_info": True,
-            "api_ef_base": "http://entityfish:8090"
+            "api_ef_base": "http://entityfish:8090",
+            "cache_size": EF_CACHE_SIZE,
+            "cache_path": EF_CACHE_PATH,
+            "cache_ttl": EF_CACHE_TTL,
+            "timeout": EF_TIMEOUT,
         }
     )
     return model
 
+
+def warm_up_pipeline(model: Language):
+    """
+    Parse a dummy question, without calling entity-fishing
+    :param model: see `token_pipeline`
+    """
+    with model.select_pipes(disable = [name for name in model.pipe_names if name == "entityfishing"]):
+        model(WARM_UP_QUESTION)
+
+def redis_connection(decode_responses: bool = True) -> redis.Redis:
+    """
+    Return a client of the Redis service
+    :param decode_responses: decode values to str
+    """
+    return redis.Redis(
+        host = os.getenv('REDIS_HOST', 'redis'),
+        port = int(os.getenv('REDIS_PORT', '6379')),
+        decode_responses = decode_responses
+    )
+
+
+
+
+def dense_retriever(
+    model: str = DENSE_MODEL,
+    backend: str = BACKEND
+) -> MultihopEmbeddingRetriever:
+    """
+    Return the dense retriever of EQA, also used to pre-embed articles
+    :param model: sentence-transformers model id
+    :param backend: torch, or onnx for the int8 ONNX Runtime export
+    """
+    retriever = OnnxMultihopEmbeddingRetriever if backend == 'onnx' else MultihopEmbeddingRetriever
+    return retriever(
+        embedding_model = model,
+        use_gpu = False,
+        model_format = 'sentence_transformers',
+        num_iterations = 2,
+        top_k = 5
+    )
+
+
+
+
+def embedding_model(model: str = DENSE_MODEL, backend: str = BACKEND) -> str:
+    """
+    Name of the embeddings of a model in the cache, quantized
+    embeddings are kept apart from the full precision ones
+    :param model: sentence-transformers model id
+    :param backend: torch or onnx
+    """
+    return model if backend == 'torch' else f"{model}@{backend}-int8"
+
+
+
+
+def answer_spans(content: str, answer) -> Optional[tuple[tuple[int, int], tuple[int, int]]]:
+    """
+    Offsets of the context and of the answer of a reader answer in a content
+    :param content: content of the document of the answer
+    :param answer: haystack Answer
+    :return: (start, end) of the context and of the answer, None if not found
+    """
+    if not answer.answer:
+        return None
+    if answer.offsets_in_document and answer.offsets_in_context:
+        start, end = answer.offsets_in_document[0].start, answer.offsets_in_document[0].end
+        context = start - answer.offsets_in_context[0].start
+        if content[start:end] == answer.answer and content[context:context + len(answer.context)] == answer.context:
+            return (context, context + len(answer.context)), (start, end)
+    # offsets not matching the content, search the text instead
+    context = content.find(answer.context)
+    start = content.find(answer.answer, max(context, 0))
+    if start == -1:
+        return None
+    if context == -1 or start + len(answer.answer) > context + len(answer.context):
+        context, end = start, start + len(answer.answer)
+    else:
+        end = context + len(answer.context)
+    return (context, end), (start, start + len(answer.answer))
+
+
+
+
+def merge_spans(spans: list[tuple[int, int, float]]) -> list[tuple[int, int, float]]:
+    """
+    Merge overlapping spans, keeping the best score
+    :param spans: (start, end, score)
+    :return: sorted disjoint spans
+    """
+    merged = list()
+    for start, end, score in sorted(spans):
+        if merged and start < merged[-1][1]:
+            last = merged[-1]
+            merged[-1] = (last[0], max(last[1], end), max(last[2], score))
+        else:
+            merged.append((start, end, score))
+    return merged
+
+
+
+
+def highlight(content: str, answers: list) -> str:
+    """
+    Highlight the answers and their contexts in a content, in a single pass.
+    Overlapping contexts or answers are merged into one span
+    :param content: content of the document
+    :param answers: haystack Answers of the document
+    :return: content with highlighted contexts and answers
+    """
+    found = [(answer, spans) for answer in answers if (spans := answer_spans(content, answer))]
+    if not found:
+        return content
+    contexts = merge_spans([(*context, 0) for _, (context, _) in found])
+    hits = merge_spans([(*span, answer.score * 100) for answer, (_, span) in found])
+
+    parts, position, i = list(), 0, 0
+    for start, end, _ in contexts:
+        parts += [content[position:start], '<span class="hglt__context">']
+        position = start
+        while i < len(hits) and hits[i][1] <= end:
+            hit_start, hit_end, score = hits[i]
+            parts += [
+                content[position:hit_start],
+                f'<span class="hglt__answer" score="{score:.2f}%">',
+                content[hit_start:hit_end], '</span>',
+            ]
+            position, i = hit_end, i + 1
+        parts += [content[position:end], '</span>']
+        position = end
+    parts.append(content[position:])
+    return ''.join(parts)
+
+
+
+
 class EQA:
     # Models below are example of models that are open-source and can be used
     def __init__(
         self,
-        dense: str = "sentence-transformers/multi-qa-mpnet-base-dot-v1",
-        ranker: str = "sebastian-hofstaetter/distilbert-dot-tas_b-b256-msmarco",
-        eqa: str = "deepset/roberta-base-squad2"
+        dense: str = DENSE_MODEL,
+        ranker: str = RANKER_MODEL,
+        eqa: str = READER_MODEL,
+        backend: str = BACKEND
     ):
-    
-        self.dense_retriever = DyMultihopEmbeddingRetriever(
-            embedding_model = dense,
+        """
+        :param backend: torch, or onnx to run the int8 ONNX Runtime exports
+        """
+        onnx = backend == 'onnx'
+        self.dense_retriever = dense_retriever(dense, backend)
+
+        self.sparse_retriever = BM25Retriever(top_k = 5)
+        self.joiner = JoinDocuments(join_mode = 'reciprocal_rank_fusion')
+        self.ranker = (OnnxSentenceTransformersRanker if onnx else SentenceTransformersRanker)(
+            model_name_or_path = ranker,
             use_gpu = False,
-            model_format = 'sentence_transformers',
-            num_iterations = 2,
             top_k = 5
         )
-
-        self.pipeline = Pipeline()
-        self.pipeline.add_node(
-            component = self.dense_retriever,
-            name = "DenseRetriever",
-            inputs = ["Query"]
-        )
-        self.pipeline.add_node(
-            component = DyBM25Retriever(top_k = 5),
-            name = "SparseRetriever",
-            inputs = ["Query"]
-        )
-        self.pipeline.add_node(
-            component = JoinDocuments(join_mode = 'reciprocal_rank_fusion'),
-            name = "JoinDocuments",
-            inputs = ["SparseRetriever", "DenseRetriever"]
-        )
-        self.pipeline.add_node(
-            component = SentenceTransformersRanker(
-                model_name_or_path = ranker,
-                use_gpu = False,
-                top_k = 5
-            ),
-            name = "Ranker",
-            inputs = ["JoinDocuments"]
-        )
-        self.pipeline.add_node(
-            component = FARMReader(
-                model_name_or_path = eqa,
-                use_gpu = False,
-                max_seq_len = 512,
-            ),
-            name = "Reader",
-            inputs = ["Ranker"]
+        self.reader = (OnnxFARMReader if onnx else FARMReader)(
+            model_name_or_path = eqa,
+            use_gpu = False,
+            max_seq_len = 512,
         )
-        self.pipeline.metrics_filter = {"DenseRetriever": ["recall_single_hit"]}
-        self.cache = redis.Redis(
-            host = 'redis',
-            port = 6379,
-            decode_responses = True
+
+        # ranker and reader run on the questions of concurrent sessions at once
+        self.batcher = MicroBatcher(self._read_batch)
+        self.cache = redis_connection(decode_responses = False)
+        self.embeddings = EmbeddingCache(
+            self.cache,
+            model = embedding_model(dense, backend),
+            dim = len(self.dense_retriever.embed_queries(["dimension"])[0]),
+            version = EMBEDDING_VERSION,
+            dtype = EMBEDDING_DTYPE,
+            ttl = EMBEDDING_TTL,
+            legacy = EMBEDDING_LEGACY and not onnx,
         )
+        self.counters = Counter()
+        self._lock = Lock()
     
 
-    def _set_cache(self, data: dict[str, list[float]]) -> None:
+    def _set_cache(self, data: dict[str, np.ndarray]) -> None:
         """
         Private. Set cache
         :param data: article ids as keys and embeddings as values
         """
-        data = {k: json.dumps(v) for k, v in data.items()}
-        self.cache.mset(data)
+        self.embeddings.set_many(data)
     
 
-    def _get_cache(self, keys: list[str]) -> dict[str, list[float]]:
+    def _get_cache(self, keys: list[str]) -> dict[str, np.ndarray]:
         """
         Private. Get cache
         :param keys: list of article ids
         :return: dictionary of article ids and embeddings
         """
-        cached = dict(
-            zip(
-                keys,
-                [
-                    json.loads(value)
-                    if value else None
-                    for value in self.cache.mget(keys)
-                ]
-            )
-        )
-        return cached
+        return self.embeddings.get_many(keys)
 
     
 
-    def _predict(
+    def _retrieve(
         self,
         query: str,
         document_store: InMemoryDocumentStore
-    ):
+    ) -> list[Document]:
         """
-        Private. Run pipeline
+        Private. Run and join the sparse and dense retrievers, as the pipeline.
+        The retrievers are shared by the inference workers: the store of the
+        session is passed to each retrieval instead of being set on them
         """
-        return self.pipeline.run(
-            query = query,
-            params = dict(
-                SparseRetriever = dict(document_store = document_store),
-                DenseRetriever = dict(document_store = document_store),
-            )
+        outputs = [
+            dict(documents = retriever.retrieve(
+                query = query,
+                top_k = retriever.top_k,
+                document_store = document_store
+            ))
+            for retriever in (self.sparse_retriever, self.dense_retriever)
+        ]
+        return self.joiner.run(inputs = outputs)[0]['documents']
+
+
+    @staticmethod
+    def _emit(on_event: EventCallback, type: str, data: Any) -> None:
+        """
+        Private. Send a partial result of a question
+        """
+        if on_event is not None:
+            on_event(type, data)
+
+
+    @staticmethod
+    def _scores(documents: list[Document]) -> list[dict[str, Any]]:
+        """
+        Private. Ids and scores of documents, scaled as in `_qa_format`
+        """
+        return [dict(id = doc.id, score = (doc.score or 0) * 100) for doc in documents]
+
+
+    def _read_batch(
+        self,
+        items: list[tuple[str, list[Document], EventCallback]]
+    ) -> list[dict[str, Any]]:
+        """
+        Private. Rank and read the documents of several questions at once
+        :param items: questions, their retrieved documents and event callbacks
+        :return: predictions of each question, as the pipeline output
+        """
+        queries = [query for query, _, _ in items]
+        documents = self.ranker.predict_batch(
+            queries = queries,
+            documents = [documents for _, documents, _ in items]
         )
+        for (_, _, on_event), docs in zip(items, documents):
+            self._emit(on_event, 'documents.ranked', self._scores(docs))
+
+        if any(on_event is not None for _, _, on_event in items):
+            answers = self._read_streamed(queries, documents, [on_event for _, _, on_event in items])
+        else:
+            answers = self.reader.predict_batch(queries = queries, documents = documents)['answers']
+        return [
+            dict(query = query, documents = docs, answers = answer)
+            for query, docs, answer in zip(queries, documents, answers)
+        ]
+    
+
+    def _read_streamed(
+        self,
+        queries: list[str],
+        documents: list[list[Document]],
+        callbacks: list[EventCallback],
+    ) -> list[list]:
+        """
+        Private. Read the documents of several questions one rank at a time,
+        sending the answers of each document as soon as it is read. Each
+        call still reads a document of every question of the batch, and the
+        answers of a question are merged as the reader merges its documents.
+        :return: answers of each question
+        """
+        answers = [list() for _ in queries]
+        for rank in range(max(map(len, documents), default = 0)):
+            reading = [i for i, docs in enumerate(documents) if rank < len(docs)]
+            found = self.reader.predict_batch(
+                queries = [queries[i] for i in reading],
+                documents = [[documents[i][rank]] for i in reading],
+            )['answers']
+            for i, answer in zip(reading, found):
+                answers[i] += answer
+                self._emit(callbacks[i], 'document.answered', dict(
+                    id = documents[i][rank].id,
+                    answers = [
+                        dict(answer = a.answer, context = a.context, score = a.score * 100)
+                        for a in answer
+                    ]
+                ))
+        return [
+            sorted(answer, key = lambda a: a.score, reverse = True)[:self.reader.top_k]
+            for answer in answers
+        ]
+
+
+    def _predict(
+        self,
+        query: str,
+        document_store: InMemoryDocumentStore,
+        on_event: EventCallback = None,
+    ) -> dict[str, Any]:
+        """
+        Private. Run pipeline, batching the ranker and reader with
+        the questions of concurrent sessions
+        """
+        documents = self._retrieve(query, document_store)
+        self._emit(on_event, 'documents.retrieved', self._scores(documents))
+        with self._lock:
+            self.counters['questions'] += 1
+        if not documents:
+            return dict(query = query, documents = [], answers = [])
+        return self.batcher.submit((query, documents, on_event))
     
     
     @staticmethod
@@ -147,78 +413,105 @@ class EQA:
         Private. Format articles to include predictions
         :param articles: list of articles
         :param predictions: predictions dictionary
-        :return: list of formatted articles
-        """
-
-        def highlight_answer(row: pd.Series) -> str:
-            """
-            Highlight the answer and score in its context in the content text
-            :param row: row of the dataframe
-            :return: content text with highlighted answer and context
-            """
-            content = row['content']
-            contexts = row['context']
-            answers = row['answer']
-            scores = row['anscore']
-            
-            if not isinstance(contexts, list):
-                return content
-
-            for context, answer, score in zip(contexts, answers, scores):
-                score = f'{score:.2f}%'
-                content = content.replace(context, f'<span class="hglt__context">{context}</span>')
-                content = content.replace(answer, f'<span class="hglt__answer" score="{score}">{answer}</span>')
-            return content
-
-        
-        answers = (
-            pd.DataFrame(
-                predictions['answers'],
-                columns=['document_ids', 'score', 'context', 'answer']
-            )
-            .explode('document_ids')
-            .rename(columns={'document_ids': 'id'})
-            .assign(anscore = lambda x: x['score'] * 100)
-            .drop(columns=['score'])
-            .groupby('id')
-            .agg(list)
-            .reset_index()
-        )
-
-        results = (
-            pd.DataFrame(articles)
-            .merge(
-                pd.DataFrame(predictions['documents'], columns=['id', 'score']),
-                on = 'id',
-                how = 'left'
-            )
-            .assign(score = lambda x: x['score'].fillna(0) * 100)
-            .merge(
-                answers,
-                on = 'id',
-                how = 'left'
-            )
-            .fillna('[]')
-            .assign(content = lambda x: x.apply(highlight_answer, axis=1))
-            .sort_values('score', ascending=False)
-        )
+        :return: list of formatted articles, by decreasing score
+        """
+        scores = {doc.id: (doc.score or 0) * 100 for doc in predictions['documents']}
+        answers: dict[str, list] = dict()
+        for answer in predictions['answers']:
+            for id in answer.document_ids or []:
+                answers.setdefault(id, []).append(answer)
 
-        return results.to_dict(orient='records')
+        results = list()
+        for article in articles:
+            found = answers.get(article['id'], [])
+            results.append({
+                **article,
+                'score': scores.get(article['id'], 0),
+                'context': [answer.context for answer in found],
+                'answer': [answer.answer for answer in found],
+                'anscore': [answer.score * 100 for answer in found],
+                'content': highlight(article['content'], found),
+            })
+        return sorted(results, key = lambda result: result['score'], reverse = True)
     
 
     def __call__(
         self,
         query: str,
         document_store: InMemoryDocumentStore,
-        articles: list[dict[str, Any]]
+        articles: list[dict[str, Any]],
+        on_event: EventCallback = None,
     ):
         """
         Call method to be used in WS server
+        :param on_event: called with the retrieved and ranked documents,
+            then the answers of each document, before the final results
         """
-        predictions = self._predict(query, document_store)
+        predictions = self._predict(query, document_store, on_event)
         return self._qa_format(articles, predictions)
 
 
+    def embed_documents(
+        self,
+        documents: list[dict[str, str]]
+    ) -> list[Document]:
+        """
+        Embed documents, only the ones missing from the cache are encoded
+        and written back to it
+        :param documents: List of documents with id and abstracts
+        :return: List of documents with embeddings
+        """
+        cached_embeddings = self._get_cache([doc['id'] for doc in documents])
+        documents = [
+            Document(
+                id = doc['id'],
+                content = doc['content'],
+                embedding = cached_embeddings.get(doc['id'], None)
+            ) for doc in documents
+        ]
+        missing = [doc for doc in documents if doc.embedding is None]
+        if missing:
+            embeddings = self.dense_retriever.embed_documents(missing)
+            for doc, embedding in zip(missing, embeddings):
+                doc.embedding = embedding
+            self._set_cache({doc.id: doc.embedding for doc in missing})
+
+        logger.info(
+            "Embeddings: %d cached, %d encoded",
+            len(documents) - len(missing), len(missing)
+        )
+        return documents
+
+
+    def warm_up(self):
+        """
+        Answer a dummy question on a dummy abstract, so that the first
+        question does not pay for the lazy allocations of the models.
+        Neither the embedding cache nor the counters are touched.
+        """
+        documents = [Document(id = 'warm-up', content = WARM_UP_ABSTRACT)]
+        for doc, embedding in zip(documents, self.dense_retriever.embed_documents(documents)):
+            doc.embedding = embedding
+        document_store = InMemoryDocumentStore(use_bm25 = True, use_gpu = False)
+        document_store.write_documents(documents)
+        self._read_batch([
+            (WARM_UP_QUESTION, self._retrieve(WARM_UP_QUESTION, document_store), None)
+        ])
+
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Counters of the EQA pipeline
+        """
+        with self._lock:
+            counters = dict(self.counters)
+        return dict(
+            **counters,
+            embeddings = self.embeddings.stats(),
+            batches = self.batcher.stats(),
+        )
+
+
     def create_document_store(
         self,
         documents: list[dict[str, str]]
@@ -232,18 +525,7 @@ class EQA:
             use_bm25 = True,
             use_gpu = False
         )
-        cached_embeddings = self._get_cache([doc['id'] for doc in documents])
-        document_store.write_documents([
-            Document(
-                id = doc['id'],
-                content = doc['content'],
-                embedding = cached_embeddings.get(doc['id'], None)
-            ) for doc in documents
-        ])
-        document_store.update_embeddings(self.dense_retriever)
-        self._set_cache({
-            doc.id: doc.embedding for doc in document_store.get_all_documents()
-        })
+        document_store.write_documents(self.embed_documents(documents))
         return document_store
         
 
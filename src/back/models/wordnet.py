@@ -0,0 +1,135 @@
+"""
+WordNet synonyms of the query words without loading WordNet.
+
+    python -m models.wordnet
+
+Builds a table of the first lemma of the synsets of every WordNet form,
+with the exception lists and suffix rules of its morphology. `synonyms`
+then reproduces `{s.lemmas()[0].name() for s in wordnet.synsets(word)}`
+with dict lookups. The table is built from the NLTK corpus when missing.
+"""
+import os, pickle
+from threading import Lock
+from typing import Any, Optional
+
+TABLE_PATH = os.getenv('WORDNET_TABLE', '.cache/wordnet.pickle')
+TABLE_VERSION = 1
+POS_LIST = ('n', 'v', 'a', 'r')
+
+_table: Optional[dict[str, Any]] = None
+_lock = Lock()
+
+
+
+
+def build(path: str = TABLE_PATH) -> dict[str, Any]:
+    """
+    Build the table from the NLTK WordNet corpus
+    :param path: pickle file written
+    :return: table
+    """
+    from nltk.corpus import wordnet
+    wordnet.ensure_loaded()
+    strings = dict()
+    intern = lambda value: strings.setdefault(value, value)
+
+    # index.adj also lists the satellite synsets, under the adjective pos
+    heads = {
+        ('a' if synset.pos() == 's' else synset.pos(), synset.offset()): intern(synset.lemmas()[0].name())
+        for synset in wordnet.all_synsets()
+    }
+    index = {pos: dict() for pos in POS_LIST}
+    for form, offsets in wordnet._lemma_pos_offset_map.items():
+        for pos in POS_LIST:
+            if pos in offsets:
+                index[pos][intern(form)] = intern(tuple(heads[pos, offset] for offset in offsets[pos]))
+    table = dict(
+        version = TABLE_VERSION,
+        index = index,
+        exceptions = {pos: dict(wordnet._exception_map[pos]) for pos in POS_LIST},
+        substitutions = {pos: list(wordnet.MORPHOLOGICAL_SUBSTITUTIONS[pos]) for pos in POS_LIST},
+    )
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    # workers may build it at the same time: each writes its own file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(table, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    return table
+
+
+def load(path: str = TABLE_PATH) -> dict[str, Any]:
+    """
+    Load the table once per process, building it if missing or outdated
+    :param path: pickle file
+    """
+    global _table
+    with _lock:
+        if _table is None:
+            table = None
+            if os.path.exists(path):
+                with open(path, 'rb') as f: table = pickle.load(f)
+            if table is None or table.get('version') != TABLE_VERSION:
+                table = build(path)
+            _table = table
+        return _table
+
+
+
+
+def morphy(table: dict[str, Any], form: str, pos: str) -> list[str]:
+    """
+    Base forms of a word for a part of speech, as `WordNetCorpusReader._morphy`
+    :param table: see `load`
+    :param form: lowercased word
+    :param pos: n, v, a or r
+    """
+    index = table['index'][pos]
+    exceptions = table['exceptions'][pos]
+    substitutions = table['substitutions'][pos]
+
+    def apply_rules(forms):
+        return [
+            form[:-len(old)] + new
+            for form in forms
+            for old, new in substitutions
+            if form.endswith(old)
+        ]
+
+    def filter_forms(forms):
+        return list(dict.fromkeys(form for form in forms if form in index))
+
+    if form in exceptions:
+        return filter_forms([form] + exceptions[form])
+    forms = apply_rules([form])
+    results = filter_forms([form] + forms)
+    while forms and not results:
+        forms = apply_rules(forms)
+        results = filter_forms(forms)
+    return results
+
+
+def synonyms(word: str) -> list[str]:
+    """
+    First lemma of each synset of a word, all parts of speech
+    :param word: word as written in the question
+    :return: lemma names, in WordNet order
+    """
+    table = load()
+    word = word.lower()
+    names = dict()
+    for pos in POS_LIST:
+        for form in morphy(table, word, pos):
+            names.update(dict.fromkeys(table['index'][pos][form]))
+    return list(names)
+
+
+
+
+if __name__ == "__main__":
+    table = build()
+    print(f"{sum(map(len, table['index'].values()))} forms written to {TABLE_PATH}")
@@ -0,0 +1,261 @@
+import asyncio, os, time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Lock
+from typing import Any, Callable, Optional
+
+WORKERS = int(os.getenv('EQA_WORKERS', '1'))
+THREADS = int(os.getenv('EQA_THREADS', '0'))
+QUEUE_SIZE = int(os.getenv('EQA_QUEUE_SIZE', '8'))
+TIMEOUT = float(os.getenv('EQA_TIMEOUT', '60'))
+BATCH_SIZE = int(os.getenv('EQA_BATCH_SIZE', '8'))
+BATCH_WAIT = float(os.getenv('EQA_BATCH_WAIT_MS', '5')) / 1000
+
+
+
+
+class Overloaded(Exception):
+    """
+    Raised when the inference queue is full
+    """
+
+
+
+
+def _limit_threads(threads: int):
+    """
+    Private. Limit the torch intra-op threads, a setting of the whole process
+    """
+    import torch
+    torch.set_num_threads(threads)
+
+
+
+
+class InferencePool:
+    """
+    Run model inference off the event loop.
+    Jobs run on `workers` threads. The torch intra-op threads of the
+    process are limited to `threads` when the pool is created, an operation
+    of each job then parallelizes over at most `threads` threads, so that
+    concurrent jobs do not oversubscribe the CPU. At most
+    `queue_size` jobs wait for a worker, further ones are rejected with
+    `Overloaded`. A job not done within its timeout is cancelled if it did
+    not start yet; a running job cannot be interrupted and keeps its slot
+    until it ends.
+    """
+    def __init__(
+        self,
+        workers: int = WORKERS,
+        threads: int = THREADS,
+        queue_size: int = QUEUE_SIZE,
+        timeout: Optional[float] = TIMEOUT,
+    ):
+        """
+        :param workers: concurrent jobs
+        :param threads: torch intra-op threads, 0 to share the CPUs between workers
+        :param queue_size: jobs waiting for a worker
+        :param timeout: seconds before a job is abandoned, None for no limit
+        """
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers = workers,
+            thread_name_prefix = 'inference',
+        )
+        _limit_threads(self.threads)
+        self._lock = Lock()
+        self.queued = self.running = 0
+        self.completed = self.failed = self.rejected = self.timeouts = 0
+        self.wait_time = self.run_time = 0.
+        self.max_queued = 0
+
+
+    def _run(self, fn: Callable, args: tuple, submitted: float):
+        """
+        Private. Run a job in a worker, timing its wait and run
+        """
+        start = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_time += start - submitted
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.run_time += time.monotonic() - start
+
+
+    def _done(self, future: Future):
+        """
+        Private. Count a finished or cancelled job
+        """
+        with self._lock:
+            if future.cancelled():
+                self.queued -= 1
+            elif future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+
+    async def run(
+        self,
+        fn: Callable,
+        *args,
+        timeout: Optional[float] = -1,
+    ) -> Any:
+        """
+        Run a job in the pool
+        :param fn: function to run
+        :param args: arguments of the function
+        :param timeout: seconds to wait, None for no limit, default to the pool timeout
+        :return: result of the function
+        :raises Overloaded: too many jobs are waiting
+        :raises asyncio.TimeoutError: the job did not end in time
+        """
+        with self._lock:
+            if self.queued >= self.workers - self.running + self.queue_size:
+                self.rejected += 1
+                raise Overloaded(f"{self.queued} inference jobs waiting")
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        future = self.executor.submit(self._run, fn, args, time.monotonic())
+        future.add_done_callback(self._done)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future),
+                self.timeout if timeout == -1 else timeout
+            )
+        except asyncio.TimeoutError:
+            with self._lock: self.timeouts += 1
+            raise
+
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            ended = self.completed + self.failed
+            return dict(
+                workers = self.workers,
+                threads = self.threads,
+                queue_size = self.queue_size,
+                queued = self.queued,
+                running = self.running,
+                max_queued = self.max_queued,
+                completed = self.completed,
+                failed = self.failed,
+                rejected = self.rejected,
+                timeouts = self.timeouts,
+                mean_wait = self.wait_time / ended if ended else None,
+                mean_run = self.run_time / ended if ended else None,
+            )
+
+
+    def close(self):
+        self.executor.shutdown(wait = False, cancel_futures = True)
+
+
+
+
+class _Slot:
+    """
+    Private. Item waiting in a batch and its result
+    """
+    def __init__(self, item: Any):
+        self.item = item
+        self.done = False
+        self.value = self.error = None
+
+
+    def result(self) -> Any:
+        if self.error is not None: raise self.error
+        return self.value
+
+
+
+
+class MicroBatcher:
+    """
+    Gather items submitted concurrently by worker threads into batches.
+    The first waiting thread leads: it waits up to `max_wait` seconds for
+    `max_items` items, runs `fn` on the batch and hands each thread its
+    result, then the next waiting thread leads the next batch.
+    A batch holds at most one item per calling thread: with a single
+    caller, items run at once without waiting.
+    """
+    def __init__(
+        self,
+        fn: Callable[[list], list],
+        max_items: int = BATCH_SIZE,
+        max_wait: float = BATCH_WAIT,
+        callers: int = WORKERS,
+    ):
+        """
+        :param fn: function mapping a list of items to the list of their results
+        :param max_items: items per batch
+        :param max_wait: seconds waited for a batch to fill
+        :param callers: threads submitting items, see `InferencePool`
+        """
+        self.fn = fn
+        self.max_items = max(1, min(max_items, callers))
+        self.max_wait = max_wait if self.max_items > 1 else 0.
+        self.histogram = Counter()
+        self._pending: list[_Slot] = list()
+        self._leading = False
+        self._cond = Condition()
+
+
+    def submit(self, item: Any) -> Any:
+        """
+        Run an item in the next batch, blocking until its result is ready
+        :param item: item of the batch
+        :return: result of the item
+        """
+        slot = _Slot(item)
+        with self._cond:
+            self._pending.append(slot)
+            self._cond.notify_all()
+            while not slot.done and (self._leading or self._pending[0] is not slot):
+                self._cond.wait()
+            if slot.done:
+                return slot.result()
+
+            self._leading = True
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_items]
+            del self._pending[:self.max_items]
+
+        try:
+            values, error = self.fn([s.item for s in batch]), None
+        except Exception as e:
+            values, error = [None] * len(batch), e
+
+        with self._cond:
+            for s, value in zip(batch, values):
+                s.value, s.error, s.done = value, error, True
+            self.histogram[len(batch)] += 1
+            self._leading = False
+            self._cond.notify_all()
+        return slot.result()
+
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            histogram = dict(sorted(self.histogram.items()))
+        batches = sum(histogram.values())
+        items = sum(size * count for size, count in histogram.items())
+        return dict(
+            max_items = self.max_items,
+            max_wait_ms = self.max_wait * 1000,
+            batches = batches,
+            mean_size = items / batches if batches else None,
+            histogram = histogram,
+        )
@@ -0,0 +1,86 @@
+import spacy
+from api.augmentation import QueryAugmenter, fallback_query
+from api.search import as_question
+
+
+
+
+def augmenter() -> QueryAugmenter:
+    """
+    Augmenter of a blank pipeline, without entity-fishing
+    """
+    return QueryAugmenter(spacy.blank("en"))
+
+
+def test_as_question_empty():
+    assert as_question("") == "?"
+    assert as_question("   ") == "   ?"
+    assert as_question("Does aspirin work?") == "Does aspirin work?"
+
+
+def test_augment_many_empty_question():
+    questions = ["Does aspirin work", "", "   ", "Is zinc effective?"]
+    query = augmenter()
+    results = query.augment_many(questions)
+    assert len(results) == len(questions)
+    assert results[0] == query("Does aspirin work")
+    assert results[3] == query("Is zinc effective?")
+    assert results[1][-1].strip(' ?') == ""
+    assert results[2][-1].strip(' ?') == ""
+
+
+def test_augment_many_failing_component():
+    def broken(doc):
+        if not doc.text.strip(' ?'): raise ValueError("empty question")
+        return doc
+    nlp = spacy.blank("en")
+    spacy.Language.component("broken", func = broken)
+    nlp.add_pipe("broken")
+    query = QueryAugmenter(nlp, retries = 0)
+    results = query.augment_many(["Does aspirin work", ""])
+    assert results[0] == query("Does aspirin work")
+    assert results[1] == fallback_query("")
+
+
+
+
+class Linker:
+    """
+    Entity-fishing stand-in counting its calls
+    """
+    def __init__(self, fail: bool = False):
+        self.calls = self.batches = 0
+        self.fail = fail
+
+    def __call__(self, doc):
+        self.calls += 1
+        return doc
+
+    def pipe(self, docs, batch_size: int = 128):
+        self.batches += 1
+        if self.fail: raise ConnectionError("entity-fishing is down")
+        return iter(docs)
+
+
+def linked(fail: bool = False) -> tuple[QueryAugmenter, Linker]:
+    linker = Linker(fail)
+    nlp = spacy.blank("en")
+    spacy.Language.component("test_linker", func = linker)
+    nlp.add_pipe("test_linker", name = "entityfishing")
+    return QueryAugmenter(nlp), linker
+
+
+def test_augment_many_batches_linker():
+    query, linker = linked()
+    results = query.augment_many(["Does aspirin work", "Is zinc effective", ""], batch_size = 32)
+    assert len(results) == 3
+    assert (linker.calls, linker.batches) == (0, 1)
+    assert query.breaker.state == 'closed'
+
+
+def test_augment_many_linker_failure():
+    query, linker = linked(fail = True)
+    results = query.augment_many(["Does aspirin work", "Is zinc effective"])
+    assert results[0][-1].startswith("Does aspirin work")
+    assert (linker.calls, linker.batches) == (0, 1)
+    assert query.stats()['linker_errors'] == 1
@@ -0,0 +1,50 @@
+import fnmatch
+from models.cache import EmbeddingCache, encode_embedding, migrate_embeddings
+
+
+
+
+class Redis(dict):
+    """
+    Stand-in of the Redis commands used by EmbeddingCache
+    """
+    def pipeline(self, transaction = True):
+        return Pipeline(self)
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def delete(self, *keys):
+        for key in keys: self.pop(key.encode() if isinstance(key, str) else key, None)
+
+    def scan_iter(self, match = '*', count = None):
+        return [key for key in list(self) if fnmatch.fnmatchcase(key.decode(), match)]
+
+    def info(self, section):
+        return dict()
+
+
+class Pipeline(list):
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def set(self, key, value, ex = None):
+        self.append(lambda: self.client.__setitem__(key.encode(), value))
+
+    def execute(self):
+        return [command() for command in self]
+
+
+def test_ids_with_colons():
+    client = Redis()
+    cache = EmbeddingCache(client, model = "model", dim = 2)
+    client[b"doi:10.1/x"] = encode_embedding([1., 2.])
+    client[b"aug:question"] = b'["question", [], [], [], "question"]'
+    client[b"emb:other:2:v1:a"] = encode_embedding([3., 4.])
+    assert migrate_embeddings(cache) == 1
+    assert client[cache.key("doi:10.1/x").encode()] == encode_embedding([1., 2.])
+    assert b"doi:10.1/x" not in client
+    assert b"aug:question" in client and b"emb:other:2:v1:a" in client
+
+    assert cache.report()['namespaces'] == {cache.namespace: 1, "emb:other:2:v1": 1}
@@ -0,0 +1,52 @@
+import pytest, requests, spacy
+from models.components import CachedEntityFishing
+
+
+
+
+def linker(status_codes: list[int]):
+    """
+    Pipeline finding "aspirin", linked by a stand-in of entity-fishing
+    answering the given status codes in turn, without entities
+    """
+    nlp = spacy.blank("en")
+    nlp.add_pipe("entity_ruler").add_patterns([{"label": "ENTITY", "pattern": "aspirin"}])
+    component = nlp.add_pipe("cached_entityfishing", name = "entityfishing", config = {
+        "api_ef_base": "http://entityfish:8090", "cache_path": "",
+    })
+    def answer(texts, terms, spans):
+        status = status_codes.pop(0)
+        return [({}, dict(status_code = status, ok = status < 400), [])]
+    component.main_disambiguation_process_batch = answer
+    return nlp, component
+
+
+def test_refused_mentions_are_cached():
+    nlp, component = linker([200, 400])
+    nlp("Does aspirin work?")
+    assert component.stats()['requests'] == 2
+    assert component.stats()['refused'] == 1
+    nlp("Is aspirin safe?")
+    assert component.stats()['requests'] == 2
+
+
+def test_server_errors_raise():
+    nlp, component = linker([500])
+    with pytest.raises(ConnectionError):
+        nlp("Does aspirin work?")
+
+
+def test_requests_time_out(monkeypatch):
+    nlp = spacy.blank("en")
+    nlp.add_pipe("entity_ruler").add_patterns([{"label": "ENTITY", "pattern": "aspirin"}])
+    nlp.add_pipe("cached_entityfishing", name = "entityfishing", config = {
+        "api_ef_base": "http://entityfish:8090", "cache_path": "", "timeout": 0.5,
+    })
+    timeouts = list()
+    def post(url, timeout = None, **kwargs):
+        timeouts.append(timeout)
+        raise requests.Timeout()
+    monkeypatch.setattr(requests, "post", post)
+    with pytest.raises(ConnectionError):
+        nlp("Does aspirin work?")
+    assert timeouts == [0.5]
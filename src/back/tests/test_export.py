@@ -0,0 +1,81 @@
+import asyncio, json, pytest
+from api.search import export_articles, async_export_articles
+from test_augmentation import augmenter
+
+
+
+
+class Results:
+    def __init__(self, hits: list, pit: str):
+        self.raw = dict(hits = dict(hits = hits), pit_id = pit)
+        self.took = 1
+
+    def to_dict(self):
+        return self.raw
+
+
+class Connection:
+    """
+    ESManager answering the pages given, an exception raising instead
+    """
+    def __init__(self, *pages):
+        self.pages = list(pages)
+        self.opened = self.closed = 0
+
+    def open_pit(self, keep_alive):
+        self.opened += 1
+        return 'pit'
+
+    def close_pit(self, pit):
+        self.closed += 1
+
+    def search(self, **kwargs):
+        page = self.pages.pop(0)
+        if isinstance(page, Exception): raise page
+        return Results(page, 'pit')
+
+    async def aopen_pit(self, keep_alive):
+        return self.open_pit(keep_alive)
+
+    async def aclose_pit(self, pit):
+        self.close_pit(pit)
+
+    async def asearch(self, **kwargs):
+        return self.search(**kwargs)
+
+
+def hit(i: int) -> dict:
+    return dict(_id = str(i), _score = 1., _source = dict(title = f"t{i}"), sort = [i])
+
+
+def test_export_first_page_error():
+    connection = Connection(ConnectionError("down"))
+    with pytest.raises(ConnectionError):
+        export_articles("Does aspirin work?", augmenter(), connection, page_size = 2)
+    assert connection.closed == 1
+
+
+def test_export_later_error():
+    connection = Connection([hit(0), hit(1)], ConnectionError("down"))
+    rows = list(export_articles("Does aspirin work?", augmenter(), connection, page_size = 2))
+    assert [json.loads(row).get('_id') for row in rows[:2]] == ['0', '1']
+    assert json.loads(rows[-1]) == dict(error = 'ConnectionError', detail = 'down')
+    assert connection.closed == 1
+
+
+def test_async_export():
+    async def export(connection):
+        rows = await async_export_articles(
+            "Does aspirin work?", augmenter(), connection, None, page_size = 2
+        )
+        return [row async for row in rows]
+
+    connection = Connection([hit(0), hit(1)], [hit(2)])
+    rows = asyncio.run(export(connection))
+    assert [json.loads(row)['_id'] for row in rows] == ['0', '1', '2']
+    assert connection.closed == 1
+
+    connection = Connection(ConnectionError("down"))
+    with pytest.raises(ConnectionError):
+        asyncio.run(export(connection))
+    assert connection.closed == 1
@@ -0,0 +1,45 @@
+import asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+from api.search import async_search_page
+from test_augmentation import augmenter
+from test_export import Connection, hit
+
+
+
+
+class Pages(dict):
+    """
+    Page cache recording the threads calling it
+    """
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def set(self, key, value):
+        self.threads.add(threading.get_ident())
+        self[key] = value
+
+    def get(self, key):
+        self.threads.add(threading.get_ident())
+        return super().get(key)
+
+
+def test_async_page_cache_off_the_loop():
+    async def pages(connection, cache, executor):
+        loop = threading.get_ident()
+        first = await async_search_page(
+            "Does aspirin work?", augmenter(), connection, executor, cache, size = 2
+        )
+        second = await async_search_page(
+            None, augmenter(), connection, executor, cache, size = 2,
+            cursor = first['cursor']
+        )
+        return loop, first, second
+
+    cache = Pages()
+    connection = Connection([hit(0), hit(1)], [hit(2)])
+    with ThreadPoolExecutor(1) as executor:
+        loop, first, second = asyncio.run(pages(connection, cache, executor))
+    assert first['cursor'] is not None and second['cursor'] is None
+    assert cache.threads and loop not in cache.threads
+    assert connection.closed == 1
@@ -0,0 +1,84 @@
+import pytest
+from types import SimpleNamespace
+from models.stores import DocumentStorePool
+
+
+
+
+class Store:
+    """
+    In-memory stand-in of InMemoryDocumentStore
+    """
+    def __init__(self):
+        self.documents = dict()
+
+    def write_documents(self, documents):
+        self.documents.update((doc.id, doc) for doc in documents)
+
+    def delete_documents(self, ids):
+        for id in ids: del self.documents[id]
+
+    def get_documents_by_id(self, ids):
+        return [self.documents[id] for id in ids]
+
+
+def pool(max_documents: int = 100) -> tuple[DocumentStorePool, list]:
+    embedded = list()
+    def embed(articles):
+        embedded.extend(article['id'] for article in articles)
+        return [SimpleNamespace(id = article['id'], embedding = [0.]) for article in articles]
+    def create(articles):
+        store = Store()
+        store.write_documents(embed(articles))
+        return store
+    return DocumentStorePool(create, embed, max_documents = max_documents), embedded
+
+
+def articles(*ids: str) -> list[dict[str, str]]:
+    return [dict(id = id, content = id) for id in ids]
+
+
+def test_shared_store_is_extended():
+    stores, embedded = pool()
+    first, shared = stores.acquire(articles("a", "b"))
+    stores.acquire(articles("a", "b"))
+    key, store = stores.acquire(articles("a", "b", "c"), first)
+    assert embedded == ["a", "b", "c"]
+    assert set(store.documents) == {"a", "b", "c"}
+    assert set(shared.documents) == {"a", "b"}
+    assert stores.stats()['extends'] == 1
+
+
+def test_owned_store_is_updated():
+    stores, embedded = pool()
+    first, store = stores.acquire(articles("a", "b"))
+    key, updated = stores.acquire(articles("b", "c"), first)
+    assert updated is store
+    assert set(store.documents) == {"b", "c"}
+    assert embedded == ["a", "b", "c"]
+
+
+def test_stores_in_use_are_not_counted():
+    stores, _ = pool(max_documents = 2)
+    stores.acquire(articles("a", "b", "c"))
+    idle, _ = stores.acquire(articles("d", "e"))
+    stores.release(idle)
+    assert stores.stats()['stores'] == 2
+    other, _ = stores.acquire(articles("f"))
+    stores.release(other)
+    # the idle stores hold 3 documents: the least recently used one goes
+    assert stores.stats()['stores'] == 2
+    assert stores.stats()['evictions'] == 1
+
+
+def test_failed_update_keeps_the_store():
+    stores, _ = pool()
+    first, store = stores.acquire(articles("a", "b"))
+    def fail(articles): raise TimeoutError()
+    stores.embed = fail
+    with pytest.raises(TimeoutError):
+        stores.acquire(articles("b", "c"), first)
+    assert set(store.documents) == {"a", "b"}
+    assert stores.entries[first].refs == 1
+    stores.release(first)
+    assert stores.entries[first].refs == 0
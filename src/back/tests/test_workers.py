@@ -0,0 +1,24 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from models.workers import MicroBatcher
+
+
+
+
+def test_single_caller_does_not_wait():
+    batcher = MicroBatcher(lambda items: items, max_items = 8, max_wait = 1., callers = 1)
+    start = time.monotonic()
+    assert batcher.submit(1) == 1
+    assert time.monotonic() - start < 0.5
+    assert batcher.stats()['histogram'] == {1: 1}
+
+
+def test_concurrent_callers_share_a_batch():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_items = 8, max_wait = 1., callers = 4)
+    with ThreadPoolExecutor(4) as executor:
+        start = time.monotonic()
+        results = list(executor.map(batcher.submit, range(4)))
+    assert results == [0, 2, 4, 6]
+    # the batch is full once every caller is in it
+    assert time.monotonic() - start < 0.5
+    assert batcher.stats()['histogram'] == {4: 1}